@@ -4,24 +4,185 @@ Generate captions for a video using OpenAI's Whisper API
 """
 
 import argparse
+import io
+import json
+import math
 import sys
 import os
 import mimetypes
+import shutil
+import socket
+import subprocess
 import tempfile
+import threading
+import time
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
-from pydub import AudioSegment
+
+import numpy as np
 
 import openai
 import pysrt
 
+import phonix_cues
+import phonix_ledger
+import phonix_queue
+import phonix_segments
+
 TWENTYFIVE_MB = 26214400
 TEMP_DIR = Path(tempfile.gettempdir())
+LOCAL_WHISPER_MODEL = "base"
+# Number of 30-second windows decoded together when captioning many files locally
+BATCH_SIZE = 16
+# Duration of one timestamp token of the Whisper models, in seconds
+TIME_PRECISION = 0.02
+# The thresholds model.transcribe uses to skip silent windows and to retry poorly decoded ones
+NO_SPEECH_THRESHOLD = 0.6
+LOGPROB_THRESHOLD = -1.0
+COMPRESSION_RATIO_THRESHOLD = 2.4
+# Sample rate of the audio the Whisper models are trained on
+SAMPLE_RATE = 16000
+# Media longer than this is split into chunks that workers caption in parallel
+CHUNK_SECONDS = 600
+# Chunks are cut at the quietest moment this many seconds around their nominal end
+SPLIT_SEARCH_SECONDS = 10
+SPLIT_SAMPLE_RATE = 4000
+FFMPEG = "ffmpeg"
+FFPROBE = "ffprobe"
+# Audio is kept in memory up to this size before it is moved to a temporary file
+SPOOL_LIMIT = 16777216
+CHUNK_SIZE = 65536
+# Audio codecs accepted by OpenAI's Whisper API, with the extension and the ffmpeg
+# muxer options to stream-copy them into a pipe (MP4 can only be streamed fragmented)
+API_AUDIO_CODECS = {
+    "mp3": ("mp3", ["-f", "mp3"]),
+    "aac": ("m4a", ["-f", "ipod", "-movflags", "frag_keyframe+empty_moov"]),
+    "flac": ("flac", ["-f", "flac"]),
+    "opus": ("ogg", ["-f", "ogg"]),
+    "vorbis": ("ogg", ["-f", "ogg"]),
+}
+API_AUDIO_EXTENSIONS = [
+    ".flac",
+    ".m4a",
+    ".mp3",
+    ".mp4",
+    ".mpeg",
+    ".mpga",
+    ".oga",
+    ".ogg",
+    ".wav",
+    ".webm",
+]
+# Subtitle streams are tagged with ISO 639-2 language codes, MP4 ignores the ISO 639-1 ones
+ISO_639_2_CODES = {
+    "af": "afr",
+    "ar": "ara",
+    "hy": "hye",
+    "az": "aze",
+    "be": "bel",
+    "bs": "bos",
+    "bg": "bul",
+    "ca": "cat",
+    "zh": "zho",
+    "hr": "hrv",
+    "cs": "ces",
+    "da": "dan",
+    "nl": "nld",
+    "en": "eng",
+    "et": "est",
+    "fi": "fin",
+    "fr": "fra",
+    "gl": "glg",
+    "de": "deu",
+    "el": "ell",
+    "he": "heb",
+    "hi": "hin",
+    "hu": "hun",
+    "is": "isl",
+    "id": "ind",
+    "it": "ita",
+    "ja": "jpn",
+    "kn": "kan",
+    "kk": "kaz",
+    "ko": "kor",
+    "lv": "lav",
+    "lt": "lit",
+    "mk": "mkd",
+    "ms": "msa",
+    "mr": "mar",
+    "mi": "mri",
+    "mn": "mon",
+    "ne": "nep",
+    "no": "nor",
+    "fa": "fas",
+    "pl": "pol",
+    "pt": "por",
+    "ro": "ron",
+    "ru": "rus",
+    "sr": "srp",
+    "sk": "slk",
+    "sl": "slv",
+    "es": "spa",
+    "sw": "swa",
+    "sv": "swe",
+    "tl": "tgl",
+    "ta": "tam",
+    "th": "tha",
+    "tr": "tur",
+    "uk": "ukr",
+    "ur": "urd",
+    "vi": "vie",
+    "cy": "cym",
+}
+# Audio tracks can be tagged with any ISO 639-2 code, including the bibliographic ones
+ISO_639_1_CODES = {
+    **{code: language for language, code in ISO_639_2_CODES.items()},
+    "arm": "hy",
+    "chi": "zh",
+    "cze": "cs",
+    "dut": "nl",
+    "fre": "fr",
+    "ger": "de",
+    "gre": "el",
+    "ice": "is",
+    "mac": "mk",
+    "mao": "mi",
+    "may": "ms",
+    "per": "fa",
+    "rum": "ro",
+    "slo": "sk",
+    "wel": "cy",
+}
+# Containers that cannot carry text subtitles as-is and the codec they need instead
+SUBTITLE_CODECS = {
+    ".mp4": "mov_text",
+    ".m4v": "mov_text",
+    ".mov": "mov_text",
+    ".webm": "webvtt",
+}
 
 
 def main():
-    parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("media", help="Path to media file", type=Path)
+    if sys.argv[1:2] == ["stats"]:
+        return phonix_ledger.main(sys.argv[2:])
+    if sys.argv[1:2] == ["worker"]:
+        return run_worker(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        epilog="Run `phonix.py stats` to aggregate the ledger of past jobs"
+        + " and `phonix.py worker --queue QUEUE` to caption the chunks of a job queue.",
+    )
+    parser.add_argument(
+        "media",
+        help="Path to media file. Several files can be given to caption them all"
+        + " (when running Whisper locally, they are decoded together in batches).",
+        type=Path,
+        nargs="+",
+    )
     parser.add_argument(
         "--output",
         help="Path to output file (default: The same filename as the input media file in the same directory)",
@@ -65,6 +226,39 @@ def main():
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--align-script",
+        help="The prompt is the exact script of the media: time it against the audio"
+        + " instead of transcribing. Much faster than transcribing, requires --language."
+        + " Will run Whisper locally.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--all-audio-tracks",
+        help="Caption every audio track of the media (e.g. dubs and commentary) at the same time,"
+        + " saving the captions of each track to <output>.track<N>.<language>.<format>",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--track-languages",
+        help="Comma-separated languages of the audio tracks, in order, when using --all-audio-tracks."
+        + " Tracks without one use the language they are tagged with, or --language.",
+        type=lambda languages: [language or None for language in languages.split(",")],
+        default=None,
+    )
+    parser.add_argument(
+        "--reuse-segments",
+        help="Reuse the captions of audio that recurs across media (e.g. intros, outros and sponsor reads)"
+        + " and only transcribe the rest. Takes the path of the index of captioned audio"
+        + f" (default: {phonix_segments.DEFAULT_INDEX},"
+        + " can be changed with the PHONIX_SEGMENT_INDEX environment variable)",
+        type=Path,
+        nargs="?",
+        const=phonix_segments.DEFAULT_INDEX,
+        default=None,
+    )
     parser.add_argument(
         "--highlight-words",
         help="Highlight each word in the captions as they are spoken. Will run Whisper locally.",
@@ -96,7 +290,104 @@ def main():
         type=int,
         default=None,
     )
+    parser.add_argument(
+        "--captions-offset-ms",
+        help="Shift all the captions by this many milliseconds (can be negative)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--min-caption-duration-ms",
+        help="Merge captions shorter than this many milliseconds into the previous one",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--max-caption-duration-ms",
+        help="Split captions longer than this many milliseconds into shorter ones",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--max-caption-gap-ms",
+        help="Extend captions to the start of the next one if the gap between them"
+        + " is at most this many milliseconds",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--max-chars-per-line",
+        help="Re-wrap captions with lines longer than this many characters",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--embed-captions",
+        help="Also write a copy of the media with the captions muxed in as a subtitle track."
+        + " Audio and video are copied as they are, without re-encoding.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--embedded-output",
+        help="Path to the media file with the embedded captions "
+        + "(default: The input media filename with a .captioned suffix in the same directory)",
+        type=Path,
+        default=None,
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="Number of 30-second audio windows decoded together when captioning"
+        + f" several files with the local Whisper model (default: {BATCH_SIZE})",
+        type=int,
+        default=BATCH_SIZE,
+    )
+    parser.add_argument(
+        "--queue",
+        help="Instead of captioning the media here, split them into chunks on this job queue"
+        + " (e.g. in a directory shared by several hosts), wait for `phonix.py worker` processes"
+        + " to caption the chunks and put the captions back together",
+        type=Path,
+        default=None,
+    )
+    parser.add_argument(
+        "--chunk-seconds",
+        help="Split media longer than this into chunks captioned in parallel when using --queue"
+        + f" (default: {CHUNK_SECONDS})",
+        type=float,
+        default=CHUNK_SECONDS,
+    )
+    parser.add_argument(
+        "--local-workers",
+        help="Number of worker processes to start on this host when using --queue",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--ledger",
+        help="Path to the ledger that records the cost, throughput and latency of every job"
+        + f" (default: {phonix_ledger.DEFAULT_LEDGER})",
+        type=Path,
+        default=phonix_ledger.DEFAULT_LEDGER,
+    )
+    parser.add_argument(
+        "--no-ledger",
+        help="Do not record this job in the ledger",
+        action="store_true",
+        default=False,
+    )
     args = parser.parse_args()
+    ledger = None if args.no_ledger else args.ledger
+    if len(args.media) > 1 and (args.output or args.embedded_output):
+        parser.error(
+            "--output and --embedded-output can only be used with one media file"
+        )
+    if args.queue and (
+        args.align_script or args.all_audio_tracks or args.reuse_segments
+    ):
+        parser.error(
+            "--align-script, --all-audio-tracks and --reuse-segments cannot be used with --queue"
+        )
 
     local_whisper_options = {
         "highlight_words": args.highlight_words,
@@ -109,19 +400,83 @@ def main():
         "font_size": args.captions_font_size,
     }
 
-    exit_code, exit_message = generate_captions(
-        media=args.media,
-        output=args.output,
-        api_key=args.api_key,
-        prompt=args.prompt,
-        format=args.output_format,
-        language=args.language,
-        translate=args.translate_to_english,
-        run_whisper_locally=args.run_whisper_locally,
-        local_whisper_options=local_whisper_options,
-        font_options=font_options,
-    )
-    print(exit_message)
+    timing_options = {
+        "offset_ms": args.captions_offset_ms,
+        "min_duration_ms": args.min_caption_duration_ms,
+        "max_duration_ms": args.max_caption_duration_ms,
+        "max_gap_ms": args.max_caption_gap_ms,
+        "max_chars_per_line": args.max_chars_per_line,
+    }
+
+    if args.queue:
+        exit_code, exit_message = coordinate(
+            queue=args.queue,
+            media_files=args.media,
+            output=args.output,
+            api_key=args.api_key,
+            prompt=args.prompt,
+            format=args.output_format,
+            language=args.language,
+            translate=args.translate_to_english,
+            run_whisper_locally=args.run_whisper_locally,
+            local_whisper_options=local_whisper_options,
+            font_options=font_options,
+            timing_options=timing_options,
+            embed_captions=args.embed_captions,
+            embedded_output=args.embedded_output,
+            chunk_seconds=args.chunk_seconds,
+            local_workers=args.local_workers,
+            ledger=ledger,
+        )
+        print(exit_message)
+        return exit_code
+
+    if (
+        len(args.media) > 1
+        and (args.run_whisper_locally or any(local_whisper_options.values()))
+        and not args.embed_captions
+        and not args.align_script
+        and not args.all_audio_tracks
+        and not args.reuse_segments
+    ):
+        exit_code, exit_message = generate_captions_batch(
+            media_files=args.media,
+            format=args.output_format,
+            language=args.language,
+            prompt=args.prompt,
+            local_whisper_options=local_whisper_options,
+            font_options=font_options,
+            timing_options=timing_options,
+            batch_size=args.batch_size,
+            ledger=ledger,
+        )
+        print(exit_message)
+        return exit_code
+
+    exit_code = 0
+    for media in args.media:
+        media_exit_code, exit_message = generate_captions(
+            media=media,
+            output=args.output,
+            api_key=args.api_key,
+            prompt=args.prompt,
+            format=args.output_format,
+            language=args.language,
+            translate=args.translate_to_english,
+            run_whisper_locally=args.run_whisper_locally,
+            local_whisper_options=local_whisper_options,
+            font_options=font_options,
+            timing_options=timing_options,
+            embed_captions=args.embed_captions,
+            embedded_output=args.embedded_output,
+            align_script=args.align_script,
+            all_audio_tracks=args.all_audio_tracks,
+            track_languages=args.track_languages,
+            segment_index=args.reuse_segments,
+            ledger=ledger,
+        )
+        print(exit_message)
+        exit_code = max(exit_code, media_exit_code)
     return exit_code
 
 
@@ -143,49 +498,477 @@ def generate_captions(
         "font": None,
         "font_size": None,
     },
+    timing_options: dict = {
+        "offset_ms": None,
+        "min_duration_ms": None,
+        "max_duration_ms": None,
+        "max_gap_ms": None,
+        "max_chars_per_line": None,
+    },
+    embed_captions: bool = False,
+    embedded_output: Path = None,
+    align_script: bool = False,
+    all_audio_tracks: bool = False,
+    track_languages: list = None,
+    segment_index: Path = None,
+    ledger: Path = None,
 ):
-    if not output:
-        output = media.with_suffix(f".{format}")
+    try:
+        transcriber = Transcriber(
+            api_key=api_key,
+            prompt=prompt,
+            format=format,
+            language=language,
+            translate=translate,
+            run_whisper_locally=run_whisper_locally,
+            local_whisper_options=local_whisper_options,
+            font_options=font_options,
+            timing_options=timing_options,
+            align_script=align_script,
+            segment_index=segment_index,
+            ledger=ledger,
+        )
+    except ValueError as e:
+        return (1, str(e))
 
-    if not media.is_file():
-        exit_message = f"Media file {media} does not exist"
-        return (1, exit_message)
+    with transcriber:
+        return transcriber.caption(
+            media,
+            output,
+            embed_captions=embed_captions,
+            embedded_output=embedded_output,
+            all_audio_tracks=all_audio_tracks,
+            track_languages=track_languages,
+        )
+
+
+class Transcriber:
+    """
+    Captions media with the same settings call after call, keeping the OpenAI client,
+    the local model, the prompt, the post-processing options and a workspace between them.
+    It can be used from several threads at once, calls to the local model take turns.
+    """
+
+    def __init__(
+        self,
+        api_key: str = os.environ.get("OPENAI_API_KEY"),
+        prompt: str = "",
+        format: str = "srt",
+        language: str = "en",
+        translate: bool = False,
+        run_whisper_locally: bool = False,
+        local_whisper_options: dict = None,
+        font_options: dict = None,
+        timing_options: dict = None,
+        align_script: bool = False,
+        segment_index: Path = None,
+        ledger: Path = None,
+    ):
+        # Copies, so that the options of the caller are never changed
+        self.local_whisper_options = {
+            "highlight_words": None,
+            "highlight_color": None,
+            "max_words_per_caption": None,
+            **(local_whisper_options or {}),
+        }
+        self.font_options = {"font": None, "font_size": None, **(font_options or {})}
+        self.timing_options = {
+            name: value for name, value in (timing_options or {}).items() if value
+        }
+
+        if any(self.local_whisper_options.values()) or align_script:
+            run_whisper_locally = True
+
+        if align_script and translate:
+            raise ValueError(
+                "A script can only be aligned to the media, not translated"
+            )
+
+        if not api_key and not run_whisper_locally:
+            raise ValueError(
+                "OpenAI API key is required, none provided or found in environment"
+            )
+
+        supported_formats = ["srt", "vtt"]
+        if format not in supported_formats:
+            raise ValueError(
+                f"Output format {format} is not supported. Must be one of: {supported_formats}"
+            )
 
-    if any(local_whisper_options.values()):
-        run_whisper_locally = True
+        try:
+            if Path(prompt).is_file():
+                with open(prompt, "r") as f:
+                    prompt = f.read()
+        except Exception:
+            # Let's suppress any errors here (e.g. due to large filename size)
+            # and just use the prompt as a string
+            pass
+
+        if align_script and not (prompt.strip() and language):
+            raise ValueError(
+                "Aligning a script requires the script as the prompt and the language of the media"
+            )
 
-    if not api_key and not run_whisper_locally:
-        exit_message = (
-            "OpenAI API key is required, none provided or found in environment"
+        self.prompt = prompt
+        self.format = format
+        self.language = language
+        self.translate = translate
+        self.run_whisper_locally = run_whisper_locally
+        self.align_script = align_script
+        self.segment_index = (
+            phonix_segments.SegmentIndex(segment_index) if segment_index else None
         )
-        return (1, exit_message)
+        self.ledger = ledger
+        self.backend = "local" if run_whisper_locally else "api"
+        self.task = (
+            "align" if align_script else "translate" if translate else "transcribe"
+        )
+        # Captions are only reused when they were made the same way
+        self.variant = json.dumps(
+            [
+                self.backend,
+                self.task,
+                language,
+                self.local_whisper_options if run_whisper_locally else None,
+            ]
+        )
+
+        self.transcribe = None
+        self.transcribe_args = None
+        if not run_whisper_locally:
+            openai_client = openai.OpenAI(api_key=api_key)
+            self.transcribe = (
+                openai_client.audio.translations.create
+                if translate
+                else openai_client.audio.transcriptions.create
+            )
+            self.transcribe_args = {
+                "model": "whisper-1",
+                "response_format": format,
+                "prompt": prompt,
+            }
+            # The translation API always translates to English and auto-detects the input language
+            # `language` is only used for transcriptions, it is set for each audio track
+
+        self._model = None
+        self._model_lock = threading.Lock()
+        self.workspace = Path(tempfile.mkdtemp(prefix="phonix-", dir=TEMP_DIR))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        shutil.rmtree(self.workspace, ignore_errors=True)
+
+    @property
+    def model(self):
+        """
+        The local model, loaded the first time it is needed
+        """
+        with self._model_lock:
+            if self._model is None:
+                self._model = load_local_model()
+        return self._model
+
+    def caption(
+        self,
+        media: Path,
+        output: Path = None,
+        embed_captions: bool = False,
+        embedded_output: Path = None,
+        all_audio_tracks: bool = False,
+        track_languages: list = None,
+        start_ms: int = 0,
+        end_ms: int = None,
+    ):
+        """
+        Caption `media`, or only its audio from `start_ms` to `end_ms` (or the end)
+        """
+        if not output:
+            output = media.with_suffix(f".{self.format}")
+        if embedded_output:
+            embed_captions = True
+        if embed_captions and not embedded_output:
+            embedded_output = media.with_name(f"{media.stem}.captioned{media.suffix}")
+
+        if not media.is_file():
+            exit_message = f"Media file {media} does not exist"
+            return (1, exit_message)
+
+        if self.segment_index and (self.align_script or all_audio_tracks):
+            exit_message = "Recurring segments can only be reused when transcribing a single audio track"
+            return (1, exit_message)
+
+        span = bool(start_ms) or end_ms is not None
+        if span and (self.segment_index or self.align_script or all_audio_tracks):
+            exit_message = "Only a single audio track can be captioned in parts"
+            return (1, exit_message)
+
+        job = {
+            "started_at": time.time(),
+            "media": str(media),
+            "files": 1,
+            "backend": self.backend,
+            "model": LOCAL_WHISPER_MODEL if self.run_whisper_locally else "whisper-1",
+            "task": self.task,
+        }
+        job_start = time.perf_counter()
+        # Jobs that raise are recorded as failed too
+        job["exit_code"] = 1
+        try:
+            exit_code, exit_message = self._caption(
+                job,
+                media,
+                output,
+                embed_captions,
+                embedded_output,
+                all_audio_tracks,
+                track_languages,
+                start_ms,
+                end_ms,
+            )
+            job["exit_code"] = exit_code
+            return (exit_code, exit_message)
+        finally:
+            job["total_seconds"] = time.perf_counter() - job_start
+            if self.ledger:
+                phonix_ledger.record_job(job, self.ledger)
+
+    def _caption(
+        self,
+        job: dict,
+        media: Path,
+        output: Path,
+        embed_captions: bool,
+        embedded_output: Path,
+        all_audio_tracks: bool,
+        track_languages: list,
+        start_ms: int,
+        end_ms: int,
+    ):
+        language = self.language
+        translate = self.translate
+        run_whisper_locally = self.run_whisper_locally
+        transcribe_or_translate = "Translating" if translate else "Transcribing"
+
+        stage_start = time.perf_counter()
+        bitrates = []
+        if all_audio_tracks:
+            probe = try_probe_media(media)
+            streams = get_audio_streams(probe) if probe else []
+            if not streams:
+                exit_message = f"Unable to find the audio tracks of {media}"
+                return (1, exit_message)
+
+            print(f"Extracting {len(streams)} audio tracks")
+            audios, bitrates = extract_audio_tracks(media, probe, run_whisper_locally)
+            tracks = []
+            for index, (stream, audio) in enumerate(zip(streams, audios)):
+                track_language = None
+                if track_languages and index < len(track_languages):
+                    track_language = track_languages[index]
+                track_language = (
+                    track_language or get_stream_language(stream) or language
+                )
+                caption_language = "en" if translate else track_language
+                language_suffix = f".{caption_language}" if caption_language else ""
+                track_output = output.with_name(
+                    f"{output.stem}.track{index + 1}{language_suffix}{output.suffix}"
+                )
+                tracks.append((audio, track_language, caption_language, track_output))
+        elif run_whisper_locally or self.segment_index:
+            # The local model and the fingerprints work on raw samples, no need for an intermediate audio file
+            audio = load_waveform(media, start_ms=start_ms, end_ms=end_ms)
+            tracks = [(audio, language, "en" if translate else language, output)]
+        elif start_ms or end_ms is not None:
+            # Only the span is encoded, straight from the media
+            probe = try_probe_media(media)
+            if end_ms is None:
+                end_ms = int((get_duration(probe) or 0) * 1000)
+            audio = get_audio_span(media, start_ms, end_ms, TWENTYFIVE_MB)
+            tracks = [(audio, language, "en" if translate else language, output)]
+        else:
+            # The audio is streamed from ffmpeg into memory and uploaded from there
+            probe = try_probe_media(media)
+            audio = get_audio(media, TWENTYFIVE_MB, probe)
+            if not audio:
+                print(
+                    "Audio is too large, must be less than 25MB, attempting to downsample"
+                )
+                job["extract_seconds"] = time.perf_counter() - stage_start
+                stage_start = time.perf_counter()
+                audio, bitrate = downsample_audio(
+                    media, TWENTYFIVE_MB, get_duration(probe)
+                )
+                bitrates.append(bitrate)
+                job["downsample_seconds"] = time.perf_counter() - stage_start
+            tracks = [(audio, language, "en" if translate else language, output)]
+        job["extract_seconds"] = job.get("extract_seconds") or (
+            time.perf_counter() - stage_start
+        )
+        job["files"] = len(tracks)
+
+        if isinstance(tracks[0][0], np.ndarray):
+            job["media_duration"] = (
+                sum(len(audio) for audio, *_ in tracks) / SAMPLE_RATE
+            )
+            job["bytes_extracted"] = sum(audio.nbytes for audio, *_ in tracks)
+            job["bytes_uploaded"] = 0
+            print(f"Decoded {job['media_duration']:.1f} seconds of audio")
+        else:
+            duration = (
+                (end_ms - start_ms) / 1000
+                if end_ms is not None
+                else get_duration(probe)
+            )
+            job["media_duration"] = (duration or 0) * len(tracks)
+            job["bytes_extracted"] = sum(get_size(audio[1]) for audio, *_ in tracks)
+            job["bytes_uploaded"] = job["bytes_extracted"]
+            print(f"Audio file size in MB: {job['bytes_uploaded'] / 1000000}")
+        if any(bitrates):
+            job["bitrate"] = ",".join(bitrate or "copy" for bitrate in bitrates)
+
+        if self.align_script:
+            transcribe_or_translate = "Aligning the script"
+        backend_name = (
+            "the local Whisper model" if run_whisper_locally else "OpenAI's Whisper API"
+        )
+        print(f"{transcribe_or_translate} using {backend_name} to {self.format} format")
+
+        stage_start = time.perf_counter()
+        # Every track is transcribed at the same time, sharing the local model if there is one
+        model = self.model if run_whisper_locally else None
+
+        def transcribe_track(track):
+            audio, track_language, _, track_output = track
+            track_transcribe_args = dict(self.transcribe_args or {})
+            if not run_whisper_locally and not translate:
+                track_transcribe_args["language"] = track_language
+            # Whisper hooks into the model to decode, so only one call can use it at a time
+            with self._model_lock if run_whisper_locally else nullcontext():
+                do_transcribe(
+                    run_whisper_locally=run_whisper_locally,
+                    audio_to_transcribe=audio,
+                    caption_format=self.format,
+                    language=track_language,
+                    prompt=self.prompt,
+                    output_filename=track_output,
+                    api_transcribe_fn=self.transcribe,
+                    transcribe_args=track_transcribe_args,
+                    local_whisper_options=self.local_whisper_options,
+                    align_script=self.align_script,
+                    model=model,
+                )
+            if isinstance(audio, tuple):
+                audio[1].close()
+
+        def transcribe_span(start_ms: int, end_ms: int, span_output: Path):
+            if run_whisper_locally:
+                samples = audio[
+                    start_ms * SAMPLE_RATE // 1000 : end_ms * SAMPLE_RATE // 1000
+                ]
+                transcribe_track((samples, language, None, span_output))
+                return
+
+            span_audio = get_audio_span(media, start_ms, end_ms, TWENTYFIVE_MB)
+            job["bytes_uploaded"] += get_size(span_audio[1])
+            transcribe_track((span_audio, language, None, span_output))
+
+        if self.segment_index:
+            transcribed_seconds = transcribe_reusing_segments(
+                self.segment_index,
+                media,
+                audio,
+                self.variant,
+                self.format,
+                output,
+                transcribe_span,
+                self.workspace,
+            )
+            job["estimated_cost"] = phonix_ledger.estimate_cost(
+                job["backend"], transcribed_seconds
+            )
+        else:
+            with ThreadPoolExecutor(max_workers=len(tracks)) as executor:
+                list(executor.map(transcribe_track, tracks))
+        job["transcribe_seconds"] = time.perf_counter() - stage_start
+
+        # Post-process the captions
+        stage_start = time.perf_counter()
+        outputs = [track_output for *_, track_output in tracks]
+        for track_output in outputs:
+            apply_timing_options(track_output, self.format, self.timing_options)
+            apply_font_options(track_output, self.format, self.font_options)
+        job["postprocess_seconds"] = time.perf_counter() - stage_start
+
+        exit_code = 0
+        saved_to = ", ".join(str(track_output) for track_output in outputs)
+        exit_message = f"Transcription complete, saved to {saved_to}"
+        if embed_captions:
+            print(f"Embedding captions into {embedded_output}")
+            stage_start = time.perf_counter()
+            try:
+                mux_captions(
+                    media,
+                    [
+                        (track_output, caption_language)
+                        for _, _, caption_language, track_output in tracks
+                    ],
+                    embedded_output,
+                )
+                exit_message = f"Transcription complete, saved to {saved_to} and embedded into {embedded_output}"
+            except subprocess.CalledProcessError as e:
+                exit_code = 1
+                exit_message = (
+                    f"Unable to embed captions into {embedded_output}: {e.stderr}"
+                )
+            job["mux_seconds"] = time.perf_counter() - stage_start
+
+        return (exit_code, exit_message)
+
+
+def generate_captions_batch(
+    media_files: list,
+    format: str = "srt",
+    language: str = None,
+    prompt: str = "",
+    local_whisper_options: dict = {
+        "highlight_words": None,
+        "highlight_color": None,
+        "max_words_per_caption": None,
+    },
+    font_options: dict = {
+        "font": None,
+        "font_size": None,
+    },
+    timing_options: dict = {
+        "offset_ms": None,
+        "min_duration_ms": None,
+        "max_duration_ms": None,
+        "max_gap_ms": None,
+        "max_chars_per_line": None,
+    },
+    batch_size: int = BATCH_SIZE,
+    ledger: Path = None,
+):
+    """
+    Caption many short media files with the local Whisper model, loading the model once
+    and decoding the 30-second windows of all the files together in batches.
+    The captions of each file are saved next to it, with the same filename.
+    """
+    for media in media_files:
+        if not media.is_file():
+            exit_message = f"Media file {media} does not exist"
+            return (1, exit_message)
 
     supported_formats = ["srt", "vtt"]
     if format not in supported_formats:
         exit_message = f"Output format {format} is not supported. Must be one of: {supported_formats}"
         return (1, exit_message)
 
-    transcribe = None
-    transcribe_args = None
-    if not run_whisper_locally:
-        openai_client = openai.OpenAI(api_key=api_key)
-        transcribe = (
-            openai_client.audio.translations.create
-            if translate
-            else openai_client.audio.transcriptions.create
-        )
-        transcribe_args = {
-            "model": "whisper-1",
-            "response_format": format,
-            "prompt": prompt,
-        }
-        if not translate:
-            # The translation API always translates to English and auto-detects the input language
-            # `language`` is only used for transcriptions
-            transcribe_args["language"] = language
-    transcribe_or_translate = "Translating" if translate else "Transcribing"
-    language = "en" if translate else language
-
     try:
         if Path(prompt).is_file():
             with open(prompt, "r") as f:
@@ -195,55 +978,443 @@ def generate_captions(
         # and just use the prompt as a string
         pass
 
-    audio = get_audio(media)
-    audio_size = audio.stat().st_size
-    if audio_size > TWENTYFIVE_MB:
+    job = {
+        "started_at": time.time(),
+        "media": str(media_files[0].parent),
+        "files": len(media_files),
+        "backend": "local",
+        "model": LOCAL_WHISPER_MODEL,
+        "task": "transcribe",
+        "bytes_uploaded": 0,
+    }
+    job_start = time.perf_counter()
+    # Jobs that raise are recorded as failed too
+    job["exit_code"] = 1
+    try:
+        outputs = [media.with_suffix(f".{format}") for media in media_files]
         print(
-            f"Audio file is too large {audio_size / 1000000}MB, must be less than 25MB, attempting to downsample"
+            f"Transcribing {len(media_files)} files using the local Whisper model to {format} format"
+        )
+        stage_start = time.perf_counter()
+        job["media_duration"] = do_transcribe_batch(
+            audio_files=media_files,
+            caption_format=format,
+            language=language,
+            prompt=prompt,
+            output_filenames=outputs,
+            local_whisper_options=local_whisper_options,
+            batch_size=batch_size,
         )
-        audio = downsample_audio(audio, TWENTYFIVE_MB)
-        audio_size = audio.stat().st_size
-    print(f"Audio file size in MB: {audio_size / 1000000}")
 
-    print(f"{transcribe_or_translate} using OpenAI's Whisper API to {format} format")
+        job["transcribe_seconds"] = time.perf_counter() - stage_start
 
-    do_transcribe(
-        run_whisper_locally=run_whisper_locally,
-        audio_to_transcribe=audio,
-        caption_format=format,
-        language=language,
-        prompt=prompt,
-        output_filename=output,
-        api_key=api_key,
-        api_transcribe_fn=transcribe,
-        transcribe_args=transcribe_args,
-        local_whisper_options=local_whisper_options,
-    )
-
-    # Post-process the captions
-    if any(font_options.values()):
-        if format == "vtt":
-            print(
-                "Font options are not supported for vtt format, request this feature on GitHub"
+        stage_start = time.perf_counter()
+        for output in outputs:
+            apply_timing_options(output, format, timing_options)
+            apply_font_options(output, format, font_options)
+        job["postprocess_seconds"] = time.perf_counter() - stage_start
+
+        job["exit_code"] = 0
+    finally:
+        job["total_seconds"] = time.perf_counter() - job_start
+        if ledger:
+            phonix_ledger.record_job(job, ledger)
+    exit_message = f"Transcription complete, saved {len(outputs)} caption files"
+    return (0, exit_message)
+
+
+def coordinate(
+    queue: Path,
+    media_files: list,
+    output: Path = None,
+    api_key: str = os.environ.get("OPENAI_API_KEY"),
+    prompt: str = "",
+    format: str = "srt",
+    language: str = "en",
+    translate: bool = False,
+    run_whisper_locally: bool = False,
+    local_whisper_options: dict = {},
+    font_options: dict = {},
+    timing_options: dict = {},
+    embed_captions: bool = False,
+    embedded_output: Path = None,
+    chunk_seconds: float = CHUNK_SECONDS,
+    local_workers: int = 0,
+    ledger: Path = None,
+    poll_seconds: float = 2,
+):
+    """
+    Split the media into chunks on a job queue, wait for the workers to caption them
+    and put the captions of every media back together
+    """
+    try:
+        if Path(prompt).is_file():
+            with open(prompt, "r") as f:
+                prompt = f.read()
+    except Exception:
+        # The workers may not have the prompt file, so it is always sent as a string
+        pass
+
+    job_queue = phonix_queue.JobQueue(queue)
+    jobs = []
+    for media in media_files:
+        if not media.is_file():
+            exit_message = f"Media file {media} does not exist"
+            return (1, exit_message)
+
+        media_output = output or media.with_suffix(f".{format}")
+        media_embedded_output = embedded_output
+        if embed_captions and not media_embedded_output:
+            media_embedded_output = media.with_name(
+                f"{media.stem}.captioned{media.suffix}"
             )
-        else:
-            captions = pysrt.open(output)
-            for caption in captions:
-                if font_options["font"]:
-                    caption.text = (
-                        f"<font face='{font_options['font']}'>{caption.text}</font>"
-                    )
-                if font_options["font_size"]:
-                    caption.text = f"<font size='{font_options['font_size']}'>{caption.text}</font>"
-            captions.save(output)
+        options = {
+            "prompt": prompt,
+            "format": format,
+            "language": language,
+            "translate": translate,
+            "run_whisper_locally": run_whisper_locally,
+            "local_whisper_options": local_whisper_options,
+            "font_options": font_options,
+            "timing_options": timing_options,
+            "embedded_output": (
+                str(media_embedded_output.resolve()) if media_embedded_output else None
+            ),
+        }
+        chunks = split_media(media, chunk_seconds)
+        # Workers on other hosts resolve the paths against the same shared directories
+        jobs.append(
+            job_queue.submit(media.resolve(), media_output.resolve(), options, chunks)
+        )
+        print(f"Queued {media} in {len(chunks)} chunk(s)")
+
+    worker_command = [
+        sys.executable,
+        str(Path(__file__).resolve()),
+        "worker",
+        "--queue",
+        str(queue),
+        "--exit-when-idle",
+    ]
+    worker_command += ["--ledger", str(ledger)] if ledger else ["--no-ledger"]
+    worker_env = {**os.environ, "OPENAI_API_KEY": api_key} if api_key else None
+    workers = [
+        subprocess.Popen(worker_command, env=worker_env) for _ in range(local_workers)
+    ]
+
+    results = {}
+    reported = None
+    while len(results) < len(jobs):
+        # Checked before the progress, so that it includes everything the workers did
+        workers_exited = workers and all(
+            worker.poll() is not None for worker in workers
+        )
+        requeued = job_queue.requeue_expired()
+        if requeued:
+            print(f"Requeued {requeued} chunk(s) of unresponsive workers")
+        progress = job_queue.progress(jobs)
+        for job in progress:
+            if job["id"] in results:
+                continue
+            if job["chunks"].get("failed"):
+                error = "; ".join(job_queue.errors(job["id"]))
+                job_queue.finish(job["id"], "failed", error)
+                # The job is lost, the workers should not spend any more time on it
+                job_queue.cancel(job["id"])
+                results[job["id"]] = (1, f"Unable to caption {job['media']}: {error}")
+            elif set(job["chunks"]) == {"done"}:
+                results[job["id"]] = assemble_job(job_queue, job)
+            elif workers_exited:
+                error = "the worker processes exited before captioning all the chunks"
+                job_queue.finish(job["id"], "failed", error)
+                job_queue.cancel(job["id"])
+                results[job["id"]] = (1, f"Unable to caption {job['media']}: {error}")
+
+        done = sum(job["chunks"].get("done", 0) for job in progress)
+        total = sum(sum(job["chunks"].values()) for job in progress)
+        if done != reported:
+            print(f"{done}/{total} chunk(s) captioned")
+            reported = done
+        if len(results) < len(jobs):
+            time.sleep(poll_seconds)
+
+    for worker in workers:
+        worker.wait()
+    exit_code = max(exit_code for exit_code, _ in results.values())
+    exit_message = "\n".join(exit_message for _, exit_message in results.values())
+    return (exit_code, exit_message)
+
+
+def split_media(media: Path, chunk_seconds: float):
+    """
+    Split `media` into (start_ms, end_ms) chunks of about `chunk_seconds`,
+    cut at the quietest moment around each boundary so that no word is cut in half
+    """
+    duration = get_duration(try_probe_media(media))
+    chunks = math.ceil(duration / chunk_seconds) if duration else 1
+    if chunks <= 1:
+        return [(0, None)]
+
+    duration_ms = int(duration * 1000)
+    # Short chunks are only searched around their middle, so none of them ends up tiny
+    search_ms = min(SPLIT_SEARCH_SECONDS * 1000, duration_ms // chunks // 4)
+    # The loudness of every tenth of a second
+    frame = SPLIT_SAMPLE_RATE // 10
+    boundaries = [0]
+    for chunk in range(1, chunks):
+        nominal = chunk * duration_ms // chunks
+        first = max(nominal - search_ms, boundaries[-1] + 100)
+        # Only the audio around the boundary is decoded, long media would not fit in memory
+        samples = load_waveform(
+            media,
+            sample_rate=SPLIT_SAMPLE_RATE,
+            start_ms=first,
+            end_ms=nominal + search_ms + 100,
+        )
+        frames = samples[: len(samples) // frame * frame].reshape(-1, frame)
+        if not len(frames):
+            boundaries.append(nominal)
+            continue
+        loudness = np.sqrt(np.mean(np.square(frames), axis=1))
+        boundaries.append(first + int(np.argmin(loudness)) * 100)
+    return [
+        (start, end if index < chunks - 1 else None)
+        for index, (start, end) in enumerate(zip(boundaries, boundaries[1:] + [None]))
+    ]
+
+
+def assemble_job(job_queue: phonix_queue.JobQueue, job: dict):
+    """
+    Put the captions of the chunks of a job together and post-process them
+    """
+    options = job["options"]
+    caption_format = options["format"]
+    output = Path(job["output"])
+    timelines = []
+    with tempfile.TemporaryDirectory(dir=TEMP_DIR) as workspace:
+        for start_ms, captions in job_queue.results(job["id"]):
+            chunk_output = Path(workspace) / f"{start_ms}.{caption_format}"
+            chunk_output.write_text(captions, encoding="utf-8")
+            timeline = phonix_cues.CueTimeline.load(chunk_output)
+            timelines.append(timeline.shift(start_ms))
+    phonix_cues.CueTimeline.concatenate(timelines).save(
+        output, vtt=caption_format == "vtt"
+    )
+    apply_timing_options(output, caption_format, options["timing_options"])
+    apply_font_options(output, caption_format, options["font_options"])
 
     exit_message = f"Transcription complete, saved to {output}"
+    if options["embedded_output"]:
+        embedded_output = Path(options["embedded_output"])
+        caption_language = "en" if options["translate"] else options["language"]
+        try:
+            mux_captions(
+                Path(job["media"]), [(output, caption_language)], embedded_output
+            )
+            exit_message += f" and embedded into {embedded_output}"
+        except subprocess.CalledProcessError as e:
+            job_queue.finish(job["id"], "failed", e.stderr)
+            exit_message = (
+                f"Unable to embed captions into {embedded_output}: {e.stderr}"
+            )
+            return (1, exit_message)
+
+    job_queue.finish(job["id"], "done")
     return (0, exit_message)
 
 
+def run_worker(argv: list = None):
+    parser = argparse.ArgumentParser(
+        prog="phonix.py worker",
+        description="Caption the chunks of media leased from a job queue"
+        + " that `phonix.py --queue` coordinates",
+    )
+    parser.add_argument(
+        "--queue",
+        help="Path to the job queue",
+        type=Path,
+        required=True,
+    )
+    parser.add_argument(
+        "--api-key",
+        help="OpenAI API key (default: The OPENAI_API_KEY environment variable)",
+        default=os.environ.get("OPENAI_API_KEY"),
+    )
+    parser.add_argument(
+        "--poll-seconds",
+        help="Seconds to wait before looking for new chunks when the queue is empty",
+        type=float,
+        default=5,
+    )
+    parser.add_argument(
+        "--exit-when-idle",
+        help="Exit once no chunks are pending or being captioned, instead of waiting for more",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--ledger",
+        help=f"Path to the ledger (default: {phonix_ledger.DEFAULT_LEDGER})",
+        type=Path,
+        default=phonix_ledger.DEFAULT_LEDGER,
+    )
+    parser.add_argument(
+        "--no-ledger",
+        help="Do not record the chunks in the ledger",
+        action="store_true",
+        default=False,
+    )
+    args = parser.parse_args(argv)
+    ledger = None if args.no_ledger else args.ledger
+
+    job_queue = phonix_queue.JobQueue(args.queue)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    transcribers = {}
+    print(f"Worker {worker} is waiting for chunks from {args.queue}")
+    while True:
+        task = job_queue.lease(worker)
+        if not task:
+            if args.exit_when_idle and not job_queue.unfinished():
+                for transcriber in transcribers.values():
+                    transcriber.close()
+                return 0
+            time.sleep(args.poll_seconds)
+            continue
+
+        print(
+            f"Captioning chunk {task['chunk'] + 1}/{task['chunks']} of {task['media']}"
+        )
+        # Keep the lease alive while captioning, or another worker gets the chunk
+        stop = threading.Event()
+
+        def keep_alive():
+            while not stop.wait(phonix_queue.LEASE_SECONDS / 3):
+                if not job_queue.heartbeat(task["id"], worker):
+                    print(f"Lost the lease of chunk {task['chunk'] + 1}")
+                    return
+
+        heartbeat = threading.Thread(target=keep_alive, daemon=True)
+        heartbeat.start()
+        try:
+            # Chunks captioned the same way share a transcriber, and with it the local model
+            options = {
+                name: task["options"][name]
+                for name in [
+                    "prompt",
+                    "format",
+                    "language",
+                    "translate",
+                    "run_whisper_locally",
+                    "local_whisper_options",
+                ]
+            }
+            key = json.dumps(options, sort_keys=True)
+            if key not in transcribers:
+                transcribers[key] = Transcriber(
+                    api_key=args.api_key, ledger=ledger, **options
+                )
+            captions = caption_chunk(task, transcribers[key])
+        except Exception as e:
+            print(f"Unable to caption chunk {task['chunk'] + 1}: {e}")
+            job_queue.fail(task["id"], worker, str(e))
+        else:
+            if not job_queue.complete(task["id"], worker, captions):
+                print(
+                    f"Chunk {task['chunk'] + 1} went to another worker or was cancelled meanwhile"
+                )
+        finally:
+            stop.set()
+            heartbeat.join()
+
+
+def caption_chunk(task: dict, transcriber: Transcriber):
+    """
+    Caption one chunk of a job and return the captions
+    """
+    media = Path(task["media"])
+    with tempfile.TemporaryDirectory(dir=transcriber.workspace) as workspace:
+        output = Path(workspace) / f"captions.{transcriber.format}"
+        # Only the chunk's span of the media is decoded
+        exit_code, exit_message = transcriber.caption(
+            media, output, start_ms=task["start_ms"], end_ms=task["end_ms"]
+        )
+        if exit_code != 0:
+            raise Exception(exit_message)
+        return output.read_text(encoding="utf-8")
+
+
+def transcribe_reusing_segments(
+    segment_index: phonix_segments.SegmentIndex,
+    media: Path,
+    samples: np.ndarray,
+    variant: str,
+    caption_format: str,
+    output: Path,
+    transcribe_span,
+    workspace: Path = TEMP_DIR,
+):
+    """
+    Reuse the captions of the segments of `samples` that recur in the media of the segment
+    index and only transcribe the rest, one span at a time with `transcribe_span`.
+    Returns the seconds of audio that had to be transcribed.
+    """
+    fingerprints, audible = phonix_segments.fingerprint(samples, SAMPLE_RATE)
+    duration_ms = len(samples) * 1000 // SAMPLE_RATE
+    reused, novel = segment_index.match(variant, fingerprints, audible, duration_ms)
+    transcribed_ms = sum(end_ms - start_ms for start_ms, end_ms in novel)
+    print(
+        f"Reusing {len(reused)} captions, transcribing {transcribed_ms / 1000:.1f}"
+        + f" of {duration_ms / 1000:.1f} seconds of audio"
+    )
+
+    timelines = [reused]
+    with tempfile.TemporaryDirectory(dir=workspace) as spans:
+        for start_ms, end_ms in novel:
+            span_output = Path(spans) / f"{start_ms}{output.suffix}"
+            transcribe_span(start_ms, end_ms, span_output)
+            span = phonix_cues.CueTimeline.load(span_output)
+            timelines.append(span.shift(start_ms))
+
+    timeline = phonix_cues.CueTimeline.concatenate(timelines)
+    timeline.save(output, vtt=caption_format == "vtt")
+    segment_index.add(media, variant, fingerprints, audible, timeline, novel)
+    return transcribed_ms / 1000
+
+
+def apply_timing_options(output: Path, caption_format: str, timing_options: dict):
+    if not any(timing_options.values()):
+        return
+
+    timeline = phonix_cues.CueTimeline.load(output)
+    timeline.apply(**timing_options)
+    timeline.save(output, vtt=caption_format == "vtt")
+    print(f"Adjusted the timing of {len(timeline)} captions")
+
+
+def apply_font_options(output: Path, caption_format: str, font_options: dict):
+    if not any(font_options.values()):
+        return
+
+    if caption_format == "vtt":
+        print(
+            "Font options are not supported for vtt format, request this feature on GitHub"
+        )
+        return
+
+    captions = pysrt.open(output)
+    for caption in captions:
+        if font_options["font"]:
+            caption.text = f"<font face='{font_options['font']}'>{caption.text}</font>"
+        if font_options["font_size"]:
+            caption.text = (
+                f"<font size='{font_options['font_size']}'>{caption.text}</font>"
+            )
+    captions.save(output)
+
+
 def do_transcribe(
     run_whisper_locally: bool,
-    audio_to_transcribe: Path,
+    audio_to_transcribe,
     caption_format: str,
     language: str,
     prompt: str,
@@ -252,85 +1423,710 @@ def do_transcribe(
     api_transcribe_fn=None,
     transcribe_args: dict = {},
     local_whisper_options: dict = {},
+    align_script: bool = False,
+    model=None,
 ):
     if run_whisper_locally:
-        try:
-            import stable_whisper
-        except ImportError:
-            print(
-                "Dependencies to run Whisper locally are not installed,"
-                + "please install them by running: "
-                + "pip install -r requirements-advanced.txt"
+        model = model or load_local_model()
+        if not isinstance(audio_to_transcribe, np.ndarray):
+            audio_to_transcribe = str(audio_to_transcribe)
+        if align_script:
+            # The prompt is the exact script, only the timing needs to be found
+            result = model.align(audio_to_transcribe, prompt, language=language)
+            if result is None:
+                raise Exception("Unable to align the script to the media")
+        else:
+            result = model.transcribe(
+                audio_to_transcribe,
+                language=language,
+                initial_prompt=prompt,
             )
-            raise
-
-        model = stable_whisper.load_model("base")
-        result = model.transcribe(
-            str(audio_to_transcribe),
-            initial_prompt=prompt,
+        save_local_result(
+            result, caption_format, output_filename, local_whisper_options
         )
+    else:
+        if isinstance(audio_to_transcribe, tuple):
+            # Already open, e.g. audio streamed into memory by get_audio
+            transcript = api_transcribe_fn(**transcribe_args, file=audio_to_transcribe)
+        else:
+            with open(audio_to_transcribe, "rb") as f:
+                transcript = api_transcribe_fn(**transcribe_args, file=f)
+        with open(output_filename, "w") as f:
+            f.write(transcript)
 
-        max_words_per_caption = local_whisper_options["max_words_per_caption"]
-        if max_words_per_caption and max_words_per_caption > 0:
-            result = result.split_by_length(max_words=max_words_per_caption)
 
-        color_tag = None
-        if local_whisper_options["highlight_color"]:
-            local_whisper_options["highlight_words"] = True
-            color = local_whisper_options["highlight_color"]
-            if color == "bold":
-                color_tag = ("<b>", "</b>")
+def do_transcribe_batch(
+    audio_files: list,
+    caption_format: str,
+    language: str,
+    prompt: str,
+    output_filenames: list,
+    local_whisper_options: dict = {},
+    batch_size: int = BATCH_SIZE,
+):
+    model = load_local_model()
+    import stable_whisper
+    import torch
+    import whisper
+
+    decoding_options = whisper.DecodingOptions(
+        language=language,
+        prompt=prompt or None,
+        without_timestamps=False,
+        fp16=model.device.type == "cuda",
+    )
+    tokenizer = whisper.tokenizer.get_tokenizer(
+        model.is_multilingual, num_languages=model.num_languages, task="transcribe"
+    )
+    segments = [[] for _ in audio_files]
+    languages = [language for _ in audio_files]
+    audio_duration = 0.0
+    # Word timings are not part of the decoded windows, they are aligned afterwards when needed
+    word_level = any(local_whisper_options.values())
+    waveforms = [None for _ in audio_files]
+    # Files with a poorly decoded window are transcribed on their own, with the temperature fallback
+    results = [None for _ in audio_files]
+
+    # Every file moves through its own windows, a batch holds the current window of several files
+    pending = deque(range(len(audio_files)))
+    seeks = [0 for _ in audio_files]
+    active = []
+    while active or pending:
+        while pending and len(active) < batch_size:
+            index = pending.popleft()
+            waveforms[index] = load_waveform(audio_files[index])
+            audio_duration += len(waveforms[index]) / SAMPLE_RATE
+            active.append(index)
+
+        mels = [
+            whisper.log_mel_spectrogram(
+                whisper.pad_or_trim(
+                    waveforms[index][
+                        seeks[index] : seeks[index] + whisper.audio.N_SAMPLES
+                    ]
+                ),
+                model.dims.n_mels,
+            )
+            for index in active
+        ]
+        decoded = whisper.decode(
+            model, torch.stack(mels).to(model.device), decoding_options
+        )
+        print(f"Decoded a batch of {len(mels)} windows")
+
+        for index, window in zip(list(active), decoded):
+            waveform = waveforms[index]
+            window_samples = min(whisper.audio.N_SAMPLES, len(waveform) - seeks[index])
+            final = seeks[index] + window_samples >= len(waveform)
+            if (
+                window.no_speech_prob > NO_SPEECH_THRESHOLD
+                and window.avg_logprob < LOGPROB_THRESHOLD
+            ):
+                # Silence or music, where the model makes up lines like "Thank you for watching"
+                seeks[index] += window_samples
+            elif (
+                window.compression_ratio > COMPRESSION_RATIO_THRESHOLD
+                or window.avg_logprob < LOGPROB_THRESHOLD
+            ):
+                print(f"Transcribing {audio_files[index]} again on its own")
+                results[index] = model.transcribe(
+                    waveform, language=language, initial_prompt=prompt
+                )
+                seeks[index] = len(waveform)
             else:
-                color_tag = (f'<font color="{color}">', "</font>")
+                languages[index] = languages[index] or window.language
+                window_segments, resume = tokens_to_segments(
+                    window.tokens,
+                    tokenizer,
+                    seeks[index] / SAMPLE_RATE,
+                    window_samples / SAMPLE_RATE,
+                    final,
+                )
+                segments[index] += window_segments
+                seeks[index] += min(round(resume * SAMPLE_RATE), window_samples)
+
+            if seeks[index] >= len(waveform):
+                active.remove(index)
+                if not word_level:
+                    waveforms[index] = None
 
-        result.to_srt_vtt(
-            str(output_filename),
-            word_level=local_whisper_options["highlight_words"],
-            tag=color_tag,
-            vtt=caption_format == "vtt",
+    for waveform, output_filename, file_segments, file_language, result in zip(
+        waveforms, output_filenames, segments, languages, results
+    ):
+        if result is None:
+            result = stable_whisper.WhisperResult(
+                {"language": file_language, "segments": file_segments}
+            )
+            if word_level and file_segments:
+                result = model.align(waveform, result, language=file_language)
+        save_local_result(
+            result, caption_format, output_filename, local_whisper_options
         )
-    else:
-        openai.api_key = api_key
-        with open(audio_to_transcribe, "rb") as f:
-            transcribe_args["file"] = f
-            transcript = api_transcribe_fn(**transcribe_args)
-        with open(output_filename, "w") as f:
-            f.write(transcript)
+        print(f"Saved captions to {output_filename}")
+
+    return audio_duration
+
 
+def tokens_to_segments(
+    tokens: list, tokenizer, offset: float, duration: float, final: bool = True
+):
+    """
+    Split the tokens decoded from a single 30-second window into timestamped segments.
+    Also returns where (in seconds into the window) the next window should start: unless
+    the window is the `final` one, a segment cut off by its end is left to the next window.
+    """
+    segments = []
+    start = 0.0
+    text_tokens = []
+    for token in tokens:
+        if token < tokenizer.timestamp_begin:
+            text_tokens.append(token)
+            continue
+        time = min((token - tokenizer.timestamp_begin) * TIME_PRECISION, duration)
+        if text_tokens:
+            segments.append(
+                {
+                    "start": offset + start,
+                    "end": offset + time,
+                    "text": tokenizer.decode(text_tokens),
+                }
+            )
+            text_tokens = []
+        start = time
 
-def get_audio(media: Path):
+    # Like model.transcribe, continue from the last complete segment unless the window ended on one
+    ended_on_segment = not text_tokens and (
+        len(tokens) < 2 or tokens[-2] < tokenizer.timestamp_begin
+    )
+    resume = segments[-1]["end"] - offset if segments else 0.0
+    if final or ended_on_segment or resume <= 0:
+        resume = duration
+        if text_tokens:
+            segments.append(
+                {
+                    "start": offset + start,
+                    "end": offset + duration,
+                    "text": tokenizer.decode(text_tokens),
+                }
+            )
+    return segments, resume
+
+
+def load_local_model():
+    try:
+        import stable_whisper
+    except ImportError:
+        print(
+            "Dependencies to run Whisper locally are not installed,"
+            + "please install them by running: "
+            + "pip install -r requirements-advanced.txt"
+        )
+        raise
+
+    return stable_whisper.load_model(LOCAL_WHISPER_MODEL)
+
+
+def save_local_result(
+    result,
+    caption_format: str,
+    output_filename: Path,
+    local_whisper_options: dict,
+):
+    max_words_per_caption = local_whisper_options["max_words_per_caption"]
+    if max_words_per_caption and max_words_per_caption > 0:
+        result = result.split_by_length(max_words=max_words_per_caption)
+
+    color_tag = None
+    word_level = local_whisper_options["highlight_words"]
+    if local_whisper_options["highlight_color"]:
+        word_level = True
+        color = local_whisper_options["highlight_color"]
+        if color == "bold":
+            color_tag = ("<b>", "</b>")
+        else:
+            color_tag = (f'<font color="{color}">', "</font>")
+
+    result.to_srt_vtt(
+        str(output_filename),
+        word_level=word_level,
+        tag=color_tag,
+        vtt=caption_format == "vtt",
+    )
+
+
+def mux_captions(media: Path, captions: list, output: Path):
+    """
+    Write `media` to `output` with every (caption file, language) pair in `captions`
+    added as a soft subtitle stream. Video and audio streams are stream-copied.
+    """
+    probe = try_probe_media(media)
+    # The new caption tracks come after the subtitle streams the media already has
+    existing = len(
+        [
+            stream
+            for stream in (probe or {}).get("streams", [])
+            if stream.get("codec_type") == "subtitle"
+        ]
+    )
+    command = [FFMPEG, "-y", "-loglevel", "error", "-i", str(media)]
+    for caption_file, _ in captions:
+        command += ["-i", str(caption_file)]
+    command += ["-map", "0:v?", "-map", "0:a?", "-map", "0:s?", "-map", "0:t?"]
+    for index in range(len(captions)):
+        command += ["-map", f"{index + 1}:0"]
+    command += ["-c", "copy"]
+    subtitle_codec = SUBTITLE_CODECS.get(output.suffix.lower())
+    for index, (caption_file, language) in enumerate(captions, start=existing):
+        if subtitle_codec:
+            command += [f"-c:s:{index}", subtitle_codec]
+        if language:
+            language = ISO_639_2_CODES.get(language, language)
+            command += [f"-metadata:s:s:{index}", f"language={language}"]
+        # MP4 names its tracks after the handler, the other containers use the title
+        for key in ["title", "handler_name"]:
+            command += [f"-metadata:s:s:{index}", f"{key}={Path(caption_file).stem}"]
+    command.append(str(output))
+
+    subprocess.run(command, check=True, capture_output=True, text=True)
+    print(f"Muxed {len(captions)} caption track(s) into {output}")
+    return output
+
+
+def probe_media(media: Path):
+    """
+    Describe the container and streams of `media` using ffprobe
+    """
+    result = subprocess.run(
+        [
+            FFPROBE,
+            "-v",
+            "error",
+            "-print_format",
+            "json",
+            "-show_format",
+            "-show_streams",
+            str(media),
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return json.loads(result.stdout)
+
+
+def get_audio_streams(probe: dict):
+    return [s for s in probe.get("streams", []) if s.get("codec_type") == "audio"]
+
+
+def has_video(probe: dict):
+    # Cover art embedded in audio files shows up as a video stream, ignore it
+    return any(
+        s.get("codec_type") == "video"
+        and not s.get("disposition", {}).get("attached_pic")
+        for s in probe.get("streams", [])
+    )
+
+
+def load_waveform(
+    media: Path,
+    stream: str = "0:a:0",
+    sample_rate: int = SAMPLE_RATE,
+    start_ms: int = 0,
+    end_ms: int = None,
+):
+    """
+    Decode an audio stream of `media` straight to the 16 kHz mono float32 samples
+    the local Whisper model works on, without writing any audio file.
+    Only the audio from `start_ms` to `end_ms` (or the end) is decoded.
+    """
+    span_args = ["-ss", str(start_ms / 1000)] if start_ms else []
+    if end_ms is not None:
+        span_args += ["-t", str((end_ms - start_ms) / 1000)]
+    result = subprocess.run(
+        [
+            FFMPEG,
+            "-nostdin",
+            "-loglevel",
+            "error",
+            *span_args,
+            "-i",
+            str(media),
+            "-map",
+            stream,
+            "-ac",
+            "1",
+            "-ar",
+            str(sample_rate),
+            "-f",
+            "f32le",
+            "-",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    # Whisper turns the samples into a tensor in place, so they must be writable
+    return np.frombuffer(bytearray(result.stdout), dtype=np.float32)
+
+
+def try_probe_media(media: Path):
+    try:
+        return probe_media(media)
+    except (OSError, subprocess.CalledProcessError, json.JSONDecodeError) as e:
+        print(f"Unable to probe {media} ({e})")
+        return None
+
+
+def get_duration(probe: dict):
+    if not probe:
+        return None
+    return float(probe["format"].get("duration") or 0)
+
+
+def get_stream_language(stream: dict):
+    """
+    The ISO 639-1 code of the language an audio stream is tagged with, if any
+    """
+    tag = stream.get("tags", {}).get("language", "").lower()
+    if tag in ISO_639_2_CODES:
+        return tag
+    return ISO_639_1_CODES.get(tag)
+
+
+def estimate_size(bitrate: str, duration: float):
+    return int(bitrate[:-1]) * 1000 * duration / 8
+
+
+def extract_audio_tracks(
+    media: Path,
+    probe: dict,
+    raw_samples: bool,
+    max_size: int = TWENTYFIVE_MB,
+    spool_limit: int = SPOOL_LIMIT,
+):
+    """
+    Extract every audio track of `media` in a single pass. With `raw_samples` the tracks
+    come back as the samples the local model works on, otherwise as (filename, file) tuples
+    ready to be uploaded. Returns the audio of each track and the bitrate it was encoded at.
+    """
+    streams = get_audio_streams(probe)
+    duration = get_duration(probe) or 0
+    outputs = []
+    filenames = []
+    bitrates = []
+    for index, stream in enumerate(streams):
+        map_args = ["-map", f"0:a:{index}", "-vn"]
+        if raw_samples:
+            outputs.append(
+                map_args + ["-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "f32le"]
+            )
+            continue
+
+        codec = stream.get("codec_name")
+        bit_rate = int(stream.get("bit_rate") or 0)
+        # Tracks without a bitrate are copied too, and downsampled if they turn out too large
+        if codec in API_AUDIO_CODECS and (
+            not bit_rate or bit_rate * duration / 8 <= max_size
+        ):
+            extension, muxer_args = API_AUDIO_CODECS[codec]
+            outputs.append(map_args + ["-c:a", "copy"] + muxer_args)
+            filenames.append(f"audio.{extension}")
+            bitrates.append(None)
+            continue
+
+        # Pick the bitrate up front, the tracks cannot be re-encoded one by one in a single pass
+        bitrate = next(
+            (
+                bitrate
+                for bitrate in ["128k", "64k", "32k", "16k"]
+                if estimate_size(bitrate, duration) <= max_size
+            ),
+            "16k",
+        )
+        outputs.append(map_args + mp3_encoder_args(bitrate))
+        filenames.append("audio.mp3")
+        bitrates.append(bitrate)
+
+    if raw_samples:
+        buffers = demux_to_buffers(media, outputs)
+        # The buffers stay in memory, so the samples can use them without a copy
+        samples = [
+            np.frombuffer(buffer.getbuffer(), dtype=np.float32) for buffer in buffers
+        ]
+        return samples, [None for _ in samples]
+
+    buffers = demux_to_buffers(media, outputs, max_size, spool_limit)
+    audios = []
+    for index, (filename, buffer) in enumerate(zip(filenames, buffers)):
+        if buffer:
+            audios.append((filename, buffer))
+            continue
+        print(f"Audio track {index + 1} is too large, attempting to downsample")
+        audio, bitrates[index] = downsample_audio(
+            media, max_size, duration, spool_limit, stream=f"0:a:{index}"
+        )
+        audios.append(audio)
+    return audios, bitrates
+
+
+def get_audio_span(media: Path, start_ms: int, end_ms: int, max_size: int):
+    """
+    Encode the audio of `media` between two points in time, at the highest bitrate that fits
+    """
+    duration = (end_ms - start_ms) / 1000
+    bitrate = next(
+        (
+            bitrate
+            for bitrate in ["128k", "64k", "32k", "16k"]
+            if estimate_size(bitrate, duration) <= max_size
+        ),
+        "16k",
+    )
+    span_args = ["-ss", str(start_ms / 1000), "-t", str(duration)]
+    audio = stream_to_buffer(
+        audio_command(media, span_args + mp3_encoder_args(bitrate)), max_size
+    )
+    if not audio:
+        raise Exception(
+            f"Unable to fit {duration} seconds of audio in {max_size} bytes"
+        )
+    return ("audio.mp3", audio)
+
+
+def get_audio(
+    media: Path,
+    max_size: int = TWENTYFIVE_MB,
+    probe: dict = None,
+    spool_limit: int = SPOOL_LIMIT,
+):
+    """
+    Get the audio of `media` ready to be uploaded, as a (filename, file) tuple.
+    Returns None if it does not fit in `max_size` without downsampling.
+    """
     print(f"Getting audio from {media}")
-    type = mimetypes.guess_type(media)[0]
-    if type == "audio":
+    if probe is None:
+        probe = try_probe_media(media)
+
+    codec = None
+    duration = 0
+    if probe:
+        audio_streams = get_audio_streams(probe)
+        if not audio_streams:
+            raise Exception(f"No audio stream found in {media}")
+        stream = audio_streams[0]
+        codec = stream.get("codec_name")
+        duration = float(stream.get("duration") or probe["format"].get("duration") or 0)
+        # The container's bitrate would include the video, only the stream's own one is used
+        bit_rate = int(stream.get("bit_rate") or 0)
+        rate = f"{bit_rate // 1000} kbps" if bit_rate else "unknown bitrate"
+        print(f"Audio stream: {codec}, {stream.get('channels')} channel(s), {rate}")
+        already_audio = not has_video(probe) and len(audio_streams) == 1
+    else:
+        type = mimetypes.guess_type(media)[0]
+        already_audio = type and type.startswith("audio/")
+
+    if (
+        already_audio
+        and media.suffix.lower() in API_AUDIO_EXTENSIONS
+        and media.stat().st_size <= max_size
+    ):
         print("Media is already audio, no need to convert")
-        return media
+        return (media.name, open(media, "rb"))
+
+    # Without a bitrate (e.g. MKV and WebM) the copy is attempted anyway, it stops once too large
+    if codec in API_AUDIO_CODECS and (
+        not bit_rate or bit_rate * duration / 8 <= max_size
+    ):
+        extension, muxer_args = API_AUDIO_CODECS[codec]
+        audio = stream_to_buffer(
+            audio_command(media, ["-c:a", "copy"] + muxer_args), max_size, spool_limit
+        )
+        if audio:
+            print("Copied audio stream without re-encoding")
+            return (f"audio.{extension}", audio)
 
-    audio = TEMP_DIR / "audio.mp3"
-    AudioSegment.from_file(media).set_channels(1).export(
-        audio, format="mp3", bitrate="128k"
+    if duration and estimate_size("128k", duration) > max_size:
+        return None
+    audio = stream_to_buffer(
+        audio_command(media, mp3_encoder_args("128k")), max_size, spool_limit
     )
-    print(f"Split audio file and saved to {audio}")
-    return audio
+    if audio:
+        print("Encoded audio to mp3")
+        return ("audio.mp3", audio)
+    return None
 
 
-def downsample_audio(audio: Path, max_size: int = TWENTYFIVE_MB):
-    print(f"Downsampling audio from {audio}")
+def downsample_audio(
+    media: Path,
+    max_size: int = TWENTYFIVE_MB,
+    duration: float = None,
+    spool_limit: int = SPOOL_LIMIT,
+    stream: str = "0:a:0",
+):
+    """
+    Encode the audio of `media` at decreasing bitrates until it fits in `max_size`.
+    Returns the audio as a (filename, file) tuple and the bitrate that was used.
+    """
+    print(f"Downsampling audio from {media}")
     bitrates = ["64k", "32k", "16k"]
     for bitrate in bitrates:
-        downsampled = TEMP_DIR / "audio_downsampled.mp3"
-        AudioSegment.from_file(audio).set_channels(1).export(
-            downsampled, format="mp3", bitrate=bitrate
+        if duration and estimate_size(bitrate, duration) > max_size:
+            # No need to encode it to find out it will not fit
+            continue
+        audio = stream_to_buffer(
+            audio_command(media, mp3_encoder_args(bitrate), stream),
+            max_size,
+            spool_limit,
         )
-        if downsampled.stat().st_size < max_size:
-            print(
-                f"Downsampled audio file and saved to {downsampled} with bitrate {bitrate}"
-            )
-            return downsampled
+        if audio:
+            print(f"Downsampled audio with bitrate {bitrate}")
+            return ("audio.mp3", audio), bitrate
 
     print("Unable to downsample audio file, it needs to be split into smaller chunks")
     print("Open a feature request on GitHub if you need this feature")
     raise Exception("Unable to downsample audio file")
 
 
+def audio_command(media: Path, output_args: list, stream: str = "0:a:0"):
+    """
+    The ffmpeg command that writes an audio stream of `media` to its standard output
+    """
+    return [
+        FFMPEG,
+        "-nostdin",
+        "-loglevel",
+        "error",
+        "-i",
+        str(media),
+        "-map",
+        stream,
+        "-vn",
+        *output_args,
+        "-",
+    ]
+
+
+def mp3_encoder_args(bitrate: str):
+    return ["-ac", "1", "-c:a", "libmp3lame", "-b:a", bitrate, "-f", "mp3"]
+
+
+def stream_to_buffer(command: list, max_size: int, spool_limit: int = SPOOL_LIMIT):
+    """
+    Collect the output of `command` in memory, moving it to a temporary file only once
+    it grows beyond `spool_limit`. Stops and returns None as soon as it exceeds `max_size`.
+    """
+    with subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    ) as process:
+        buffer = read_to_buffer(process.stdout, max_size, spool_limit)
+        if buffer is None:
+            process.kill()
+            return None
+        stderr = process.stderr.read()
+
+    if process.returncode != 0:
+        buffer.close()
+        raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr)
+    return buffer
+
+
+def demux_to_buffers(
+    media: Path,
+    outputs: list,
+    max_size: int = None,
+    spool_limit: int = None,
+):
+    """
+    Write several outputs of `media` (one list of ffmpeg output options each) in a single
+    ffmpeg pass, each to its own pipe, and collect them like stream_to_buffer does.
+    Outputs larger than `max_size` come back as None.
+    """
+    input_args = [FFMPEG, "-nostdin", "-loglevel", "error", "-i", str(media)]
+
+    def one_pass_per_output():
+        return [
+            stream_to_buffer(input_args + output_args + ["-"], max_size, spool_limit)
+            for output_args in outputs
+        ]
+
+    if os.name != "posix":
+        # Extra pipes can only be handed over to ffmpeg on POSIX, read the media once per output
+        return one_pass_per_output()
+
+    pipes = [os.pipe() for _ in outputs]
+    command = list(input_args)
+    for output_args, (_, write_fd) in zip(outputs, pipes):
+        command += output_args + [f"pipe:{write_fd}"]
+
+    def collect(read_fd):
+        with os.fdopen(read_fd, "rb") as reader:
+            # Keep reading outputs that grew too large, ffmpeg would block on them otherwise
+            return read_to_buffer(reader, max_size, spool_limit, drain=True)
+
+    with subprocess.Popen(
+        command, stderr=subprocess.PIPE, pass_fds=[write_fd for _, write_fd in pipes]
+    ) as process:
+        for _, write_fd in pipes:
+            os.close(write_fd)
+        with ThreadPoolExecutor(max_workers=len(pipes)) as executor:
+            buffers = list(executor.map(collect, [read_fd for read_fd, _ in pipes]))
+        stderr = process.stderr.read()
+
+    if process.returncode != 0:
+        for buffer in buffers:
+            if buffer:
+                buffer.close()
+        raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr)
+    # ffmpeg still exits cleanly when it cannot write to a pipe, e.g. when a wrapper script
+    # (pyenv, pip's ffmpeg packages) runs it without the pipes
+    if any(buffer and get_size(buffer) == 0 for buffer in buffers):
+        for buffer in buffers:
+            if buffer:
+                buffer.close()
+        reason = stderr.decode(errors="replace").strip() or "no output"
+        print(
+            f"Unable to demux in a single pass ({reason}), reading the media once per output"
+        )
+        return one_pass_per_output()
+    return buffers
+
+
+def read_to_buffer(
+    reader, max_size: int = None, spool_limit: int = None, drain: bool = False
+):
+    """
+    Read `reader` to its end into memory, or into a temporary file beyond `spool_limit`.
+    Returns None if it is larger than `max_size`, without reading the rest unless `drain`.
+    """
+    buffer = io.BytesIO()
+    size = 0
+    while chunk := reader.read(CHUNK_SIZE):
+        size += len(chunk)
+        if max_size and size > max_size:
+            if buffer:
+                print(f"Audio is larger than {max_size / 1000000}MB")
+                buffer.close()
+                buffer = None
+            if not drain:
+                return None
+            continue
+        if spool_limit and size > spool_limit and isinstance(buffer, io.BytesIO):
+            spooled = tempfile.TemporaryFile(dir=TEMP_DIR)
+            spooled.write(buffer.getvalue())
+            buffer.close()
+            buffer = spooled
+        buffer.write(chunk)
+
+    if buffer:
+        buffer.seek(0)
+    return buffer
+
+
+def get_size(file):
+    position = file.tell()
+    size = file.seek(0, io.SEEK_END)
+    file.seek(position)
+    return size
+
+
 if __name__ == "__main__":
     sys.exit(main())
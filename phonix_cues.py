@@ -0,0 +1,250 @@
+"""
+Vectorized timing operations for large caption files
+"""
+
+import re
+import textwrap
+
+from pathlib import Path
+
+import numpy as np
+
+# The text is every non-blank line after the timing line, possibly none at all
+CUE_PATTERN = re.compile(
+    r"(?:(\d+):)?(\d{2}):(\d{2})[,.](\d{3})[ \t]+-->[ \t]+"
+    + r"(?:(\d+):)?(\d{2}):(\d{2})[,.](\d{3})[^\n]*(?:\n|\Z)"
+    + r"((?:[^\n]*\S[^\n]*(?:\n|\Z))*)"
+)
+TAG_PATTERN = re.compile(r"<[^>]*>")
+# Milliseconds in an hour, a minute and a second, to convert the parsed timestamp fields
+TIMESTAMP_UNITS = np.array([3600000, 60000, 1000, 1], dtype=np.int64)
+
+
+class CueTimeline:
+    """
+    Captions stored as arrays of start and end times (in milliseconds) next to their texts,
+    so that timing operations run over all the cues at once instead of one cue at a time.
+    """
+
+    def __init__(self, starts, ends, texts: list):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.texts = np.asarray(texts, dtype=object)
+        if self.texts.ndim != 1:
+            # Texts that look like sequences must not become extra dimensions
+            self.texts = np.empty(len(texts), dtype=object)
+            self.texts[:] = list(texts)
+
+    def __len__(self):
+        return len(self.texts)
+
+    @classmethod
+    def load(cls, captions: Path):
+        """
+        Read an SRT or VTT file
+        """
+        return cls.parse(Path(captions).read_text(encoding="utf-8"))
+
+    @classmethod
+    def parse(cls, content: str):
+        """
+        Parse the cues of SRT or VTT content. Cues without text are kept as they are:
+
+        >>> timeline = CueTimeline.parse(
+        ...     "1\\n00:00:01,000 --> 00:00:02,000\\n\\n2\\n00:00:03,000 --> 00:00:04,000\\nb\\n"
+        ... )
+        >>> timeline.starts.tolist(), timeline.texts.tolist()
+        ([1000, 3000], ['', 'b'])
+        """
+        matches = CUE_PATTERN.findall(content.replace("\r\n", "\n"))
+        if not matches:
+            return cls([], [], [])
+
+        fields = np.array(matches, dtype=object)
+        timestamps = fields[:, :8].astype(str)
+        # Hours are optional in VTT
+        timestamps = np.where(timestamps == "", "0", timestamps).astype(np.int64)
+        return cls(
+            timestamps[:, :4] @ TIMESTAMP_UNITS,
+            timestamps[:, 4:8] @ TIMESTAMP_UNITS,
+            [text.rstrip("\n") for text in fields[:, 8]],
+        )
+
+    @classmethod
+    def concatenate(cls, timelines: list):
+        """
+        Combine the cues of several timelines, in the order they start
+        """
+        if not timelines:
+            return cls([], [], [])
+
+        starts = np.concatenate([timeline.starts for timeline in timelines])
+        order = np.argsort(starts, kind="stable")
+        return cls(
+            starts[order],
+            np.concatenate([timeline.ends for timeline in timelines])[order],
+            np.concatenate([timeline.texts for timeline in timelines])[order],
+        )
+
+    def save(self, captions: Path, vtt: bool = False):
+        separator = "." if vtt else ","
+        starts = format_timestamps(self.starts, separator)
+        ends = format_timestamps(self.ends, separator)
+        if vtt:
+            blocks = [
+                f"{start} --> {end}\n{text}"
+                for start, end, text in zip(starts, ends, self.texts)
+            ]
+            content = "WEBVTT\n\n" + "\n\n".join(blocks)
+        else:
+            blocks = [
+                f"{index}\n{start} --> {end}\n{text}"
+                for index, (start, end, text) in enumerate(
+                    zip(starts, ends, self.texts), start=1
+                )
+            ]
+            content = "\n\n".join(blocks)
+        Path(captions).write_text(content + "\n", encoding="utf-8")
+
+    def _keep(self, mask):
+        self.starts = self.starts[mask]
+        self.ends = self.ends[mask]
+        self.texts = self.texts[mask]
+
+    def shift(self, offset_ms: int):
+        """
+        Move all cues by `offset_ms`, dropping the ones that end up before the start
+        """
+        self.starts = np.maximum(self.starts + offset_ms, 0)
+        self.ends = self.ends + offset_ms
+        self._keep(self.ends > 0)
+        return self
+
+    def merge_short(self, min_duration_ms: int):
+        """
+        Merge every cue shorter than `min_duration_ms` into the previous one,
+        as long as the gap between them is not longer than `min_duration_ms` either
+        """
+        if len(self) < 2:
+            return self
+
+        merge = np.zeros(len(self), dtype=bool)
+        merge[1:] = (self.ends[1:] - self.starts[1:] < min_duration_ms) & (
+            self.starts[1:] - self.ends[:-1] <= min_duration_ms
+        )
+        heads = np.flatnonzero(~merge)
+        tails = np.append(heads[1:], len(self))
+        texts = self.texts[heads]
+        for group in np.flatnonzero(tails - heads > 1):
+            texts[group] = " ".join(self.texts[heads[group] : tails[group]])
+        self.ends = np.maximum.reduceat(self.ends, heads)
+        self.starts = self.starts[heads]
+        self.texts = texts
+        return self
+
+    def split_long(self, max_duration_ms: int):
+        """
+        Split every cue longer than `max_duration_ms` into equally long cues,
+        spreading its words evenly among them
+        """
+        durations = self.ends - self.starts
+        pieces = np.maximum(-(-durations // max_duration_ms), 1)
+        if not (pieces > 1).any():
+            return self
+
+        index = np.repeat(np.arange(len(self)), pieces)
+        piece = np.arange(len(index)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        step = durations[index] / pieces[index]
+        starts = self.starts[index] + (piece * step).astype(np.int64)
+        ends = self.starts[index] + ((piece + 1) * step).astype(np.int64)
+
+        texts = self.texts[index]
+        first_pieces = np.cumsum(pieces) - pieces
+        for cue, count, first in zip(
+            *[
+                array[pieces > 1].tolist()
+                for array in (self.texts, pieces, first_pieces)
+            ]
+        ):
+            words = mask_tags(cue).split()
+            bounds = [len(words) * piece // count for piece in range(count + 1)]
+            texts[first : first + count] = [
+                " ".join(words[a:b]).replace("\0", " ")
+                for a, b in zip(bounds[:-1], bounds[1:])
+            ]
+
+        self.starts, self.ends, self.texts = starts, ends, texts
+        # Cues without any words left are not worth showing
+        self._keep(texts != "")
+        return self
+
+    def close_gaps(self, max_gap_ms: int):
+        """
+        Extend cues up to the start of the next one when the gap between them
+        is not longer than `max_gap_ms`, so the captions do not flicker
+        """
+        if len(self) < 2:
+            return self
+
+        gaps = self.starts[1:] - self.ends[:-1]
+        close = (gaps > 0) & (gaps <= max_gap_ms)
+        self.ends[:-1] = np.where(close, self.starts[1:], self.ends[:-1])
+        return self
+
+    def reflow(self, max_chars_per_line: int):
+        """
+        Re-wrap the cues that have lines longer than `max_chars_per_line`
+        """
+        for index, text in enumerate(self.texts.tolist()):
+            if all(len(line) <= max_chars_per_line for line in text.split("\n")):
+                continue
+            self.texts[index] = textwrap.fill(
+                mask_tags(text).replace("\n", " "),
+                width=max_chars_per_line,
+                break_long_words=False,
+                break_on_hyphens=False,
+            ).replace("\0", " ")
+        return self
+
+    def apply(
+        self,
+        offset_ms: int = None,
+        min_duration_ms: int = None,
+        max_duration_ms: int = None,
+        max_gap_ms: int = None,
+        max_chars_per_line: int = None,
+    ):
+        """
+        Run the operations that have a value, in an order where they do not undo each other
+        """
+        if offset_ms:
+            self.shift(offset_ms)
+        if min_duration_ms:
+            self.merge_short(min_duration_ms)
+        if max_duration_ms:
+            self.split_long(max_duration_ms)
+        if max_gap_ms:
+            self.close_gaps(max_gap_ms)
+        if max_chars_per_line:
+            self.reflow(max_chars_per_line)
+        return self
+
+
+def mask_tags(text: str):
+    """
+    Hide the spaces inside tags, so that splitting the text on whitespace keeps them in one piece
+    """
+    return TAG_PATTERN.sub(lambda tag: tag.group().replace(" ", "\0"), text)
+
+
+def format_timestamps(milliseconds, separator: str = ","):
+    milliseconds = np.maximum(milliseconds, 0)
+    hours, remainder = np.divmod(milliseconds, 3600000)
+    minutes, remainder = np.divmod(remainder, 60000)
+    seconds, milliseconds = np.divmod(remainder, 1000)
+    return [
+        f"{h:02d}:{m:02d}:{s:02d}{separator}{ms:03d}"
+        for h, m, s, ms in zip(
+            hours.tolist(), minutes.tolist(), seconds.tolist(), milliseconds.tolist()
+        )
+    ]
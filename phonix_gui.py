@@ -4,6 +4,7 @@ The GUI for phonix.py
 """
 
 import phonix
+import phonix_ledger
 import sys
 import PySimpleGUI as sg
 import os.path
@@ -50,7 +51,16 @@ def main():
             enable_events=True,
         ),
     ]
-    output_file = [select_output_file, output_file_input]
+    embed_captions = [
+        sg.Checkbox(
+            "Embed captions into a copy of the media",
+            key="embed_captions",
+            background_color="gray",
+            tooltip="Mux the captions into the media as a subtitle track, "
+            + "without re-encoding the audio or video.",
+        )
+    ]
+    output_file = [select_output_file, output_file_input, embed_captions]
 
     # API key
     select_api_key = [
@@ -106,7 +116,22 @@ def main():
         sg.FileBrowse(disabled=True, key="prompt_file_input_browse"),
     ]
     prompt_string_input = [sg.Multiline(key="prompt_string_input", size=(50, 5))]
-    prompt = [select_prompt, prompt_type, prompt_string_input, prompt_file_input]
+    align_script = [
+        sg.Checkbox(
+            "The prompt is the exact script",
+            key="align_script",
+            background_color="gray",
+            tooltip="Time the script against the media instead of transcribing it. "
+            + "Runs Whisper locally and requires the language of the media.",
+        )
+    ]
+    prompt = [
+        select_prompt,
+        prompt_type,
+        prompt_string_input,
+        prompt_file_input,
+        align_script,
+    ]
 
     # Captions format
     select_captions_format = [
@@ -590,6 +615,9 @@ def main():
                 run_whisper_locally=run_whisper_locally_value,
                 local_whisper_options=local_whisper_options,
                 font_options=font_options,
+                embed_captions=values["embed_captions"],
+                align_script=values["align_script"],
+                ledger=phonix_ledger.DEFAULT_LEDGER,
             )
             popup = sg.popup_ok if exit_code == 0 else sg.popup_error
             popup(exit_message)
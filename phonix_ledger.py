@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Aggregate the ledger of cost, throughput and latency that phonix keeps for every job
+"""
+
+import argparse
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+from pathlib import Path
+
+DEFAULT_LEDGER = Path(
+    os.environ.get("PHONIX_LEDGER", Path.home() / ".phonix" / "ledger.sqlite3")
+)
+# OpenAI's price for the Whisper API in USD per minute of audio
+WHISPER_API_COST_PER_MINUTE = 0.006
+STAGES = ["extract", "downsample", "transcribe", "postprocess", "mux"]
+COLUMNS = {
+    "started_at": "REAL",
+    "host": "TEXT",
+    "media": "TEXT",
+    "files": "INTEGER",
+    "backend": "TEXT",
+    "model": "TEXT",
+    "task": "TEXT",
+    "media_duration": "REAL",
+    "bytes_extracted": "INTEGER",
+    "bytes_uploaded": "INTEGER",
+    "bitrate": "TEXT",
+    **{f"{stage}_seconds": "REAL" for stage in STAGES},
+    "total_seconds": "REAL",
+    "estimated_cost": "REAL",
+    "exit_code": "INTEGER",
+}
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(prog="phonix.py stats", description=__doc__)
+    parser.add_argument(
+        "--ledger",
+        help=f"Path to the ledger (default: {DEFAULT_LEDGER},"
+        + " can be changed with the PHONIX_LEDGER environment variable)",
+        type=Path,
+        default=DEFAULT_LEDGER,
+    )
+    parser.add_argument(
+        "--since-days",
+        help="Only aggregate the jobs of the last N days",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--prometheus",
+        help="Also write the aggregated metrics to this file in the Prometheus textfile format",
+        type=Path,
+        default=None,
+    )
+    args = parser.parse_args(argv)
+
+    if not args.ledger.is_file():
+        print(f"No ledger found at {args.ledger}")
+        return 1
+
+    since = time.time() - args.since_days * 86400 if args.since_days else 0
+    rows = summarize(args.ledger, since)
+    print(format_summary(rows))
+    if args.prometheus:
+        write_prometheus(rows, args.prometheus)
+        print(f"Metrics written to {args.prometheus}")
+    return 0
+
+
+def connect(ledger: Path):
+    ledger.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(ledger, timeout=30)
+    columns = ", ".join(f"{name} {type}" for name, type in COLUMNS.items())
+    connection.execute(f"CREATE TABLE IF NOT EXISTS jobs ({columns})")
+    return connection
+
+
+def estimate_cost(backend: str, media_duration: float):
+    if backend != "api" or not media_duration:
+        return 0.0
+    return media_duration / 60 * WHISPER_API_COST_PER_MINUTE
+
+
+def record_job(job: dict, ledger: Path = DEFAULT_LEDGER):
+    """
+    Append a job to the ledger. Unknown keys are ignored and missing ones are left empty.
+    """
+    job = {"host": socket.gethostname(), **job}
+    job.setdefault(
+        "estimated_cost", estimate_cost(job.get("backend"), job.get("media_duration"))
+    )
+    names = [name for name in COLUMNS if name in job]
+    placeholders = ", ".join("?" for _ in names)
+    try:
+        with connect(ledger) as connection:
+            connection.execute(
+                f"INSERT INTO jobs ({', '.join(names)}) VALUES ({placeholders})",
+                [job[name] for name in names],
+            )
+        connection.close()
+    except (sqlite3.Error, OSError) as e:
+        # The ledger is bookkeeping, it should never fail the job itself
+        print(f"Unable to record the job in the ledger {ledger}: {e}")
+
+
+def summarize(ledger: Path, since: float = 0):
+    """
+    Aggregate the jobs of the ledger per backend and model
+    """
+    stage_sums = ", ".join(
+        f"SUM(COALESCE({stage}_seconds, 0)) AS {stage}_seconds" for stage in STAGES
+    )
+    connection = connect(ledger)
+    connection.row_factory = sqlite3.Row
+    rows = connection.execute(
+        f"""
+        SELECT
+            backend,
+            model,
+            COUNT(*) AS jobs,
+            SUM(exit_code != 0) AS failed_jobs,
+            SUM(COALESCE(files, 1)) AS files,
+            SUM(COALESCE(media_duration, 0)) AS media_duration,
+            SUM(COALESCE(bytes_extracted, 0)) AS bytes_extracted,
+            SUM(COALESCE(bytes_uploaded, 0)) AS bytes_uploaded,
+            {stage_sums},
+            SUM(COALESCE(total_seconds, 0)) AS total_seconds,
+            SUM(COALESCE(estimated_cost, 0)) AS estimated_cost
+        FROM jobs
+        WHERE started_at >= ?
+        GROUP BY backend, model
+        ORDER BY backend, model
+        """,
+        (since,),
+    ).fetchall()
+    connection.close()
+    return [dict(row) for row in rows]
+
+
+def format_summary(rows: list):
+    if not rows:
+        return "No jobs recorded"
+
+    lines = []
+    for row in rows:
+        transcribe_seconds = row["transcribe_seconds"]
+        throughput = (
+            row["media_duration"] / transcribe_seconds if transcribe_seconds else 0
+        )
+        stages = ", ".join(
+            f"{stage} {row[f'{stage}_seconds'] / row['jobs']:.1f}s" for stage in STAGES
+        )
+        lines += [
+            f"{row['backend']} ({row['model']})",
+            f"  Jobs: {row['jobs']} ({row['failed_jobs']} failed), files: {row['files']}",
+            f"  Audio: {row['media_duration'] / 60:.1f} minutes",
+            f"  Extracted: {row['bytes_extracted'] / 1000000:.1f}MB,"
+            + f" uploaded: {row['bytes_uploaded'] / 1000000:.1f}MB",
+            f"  Throughput: {throughput:.1f} audio seconds per second of transcription",
+            f"  Average latency per job: {stages}",
+            f"  Estimated cost: ${row['estimated_cost']:.2f}",
+        ]
+    return "\n".join(lines)
+
+
+def write_prometheus(rows: list, path: Path):
+    """
+    Write the aggregated metrics for node_exporter's textfile collector
+    """
+    metrics = {
+        "phonix_jobs_total": ("counter", "Number of jobs", "jobs"),
+        "phonix_failed_jobs_total": ("counter", "Number of failed jobs", "failed_jobs"),
+        "phonix_audio_seconds_total": (
+            "counter",
+            "Seconds of audio captioned",
+            "media_duration",
+        ),
+        "phonix_extracted_bytes_total": (
+            "counter",
+            "Bytes of audio extracted from the media",
+            "bytes_extracted",
+        ),
+        "phonix_uploaded_bytes_total": (
+            "counter",
+            "Bytes of audio uploaded to the API",
+            "bytes_uploaded",
+        ),
+        "phonix_estimated_cost_dollars_total": (
+            "counter",
+            "Estimated API cost in USD",
+            "estimated_cost",
+        ),
+    }
+    lines = []
+    for name, (type, help, key) in metrics.items():
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+        for row in rows:
+            labels = f'backend="{row["backend"]}",model="{row["model"]}"'
+            lines.append(f"{name}{{{labels}}} {row[key]}")
+
+    name = "phonix_stage_seconds_total"
+    lines += [
+        f"# HELP {name} Wall time spent in each stage of the jobs",
+        f"# TYPE {name} counter",
+    ]
+    for row in rows:
+        for stage in STAGES:
+            labels = (
+                f'backend="{row["backend"]}",model="{row["model"]}",stage="{stage}"'
+            )
+            lines.append(f"{name}{{{labels}}} {row[f'{stage}_seconds']}")
+
+    # Write to a temporary file first, so the collector never reads a partial file
+    temporary = path.with_name(f".{path.name}.tmp")
+    temporary.write_text("\n".join(lines) + "\n")
+    os.replace(temporary, path)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,238 @@
+"""
+Queue of captioning jobs shared by a coordinator and the workers of several hosts.
+Jobs are split into chunks of media that workers lease, keep alive with heartbeats
+and complete with their captions. Leases that are not kept alive go back to the queue.
+"""
+
+import json
+import sqlite3
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+
+# Seconds a worker may go without a heartbeat before its chunk goes to another worker
+LEASE_SECONDS = 60
+# Chunks failing this many times fail their job
+MAX_ATTEMPTS = 3
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, media TEXT, output TEXT,"
+    + " options TEXT, status TEXT, error TEXT, created_at REAL, finished_at REAL)",
+    "CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, job INTEGER, chunk INTEGER,"
+    + " chunks INTEGER, start_ms INTEGER, end_ms INTEGER, status TEXT, worker TEXT,"
+    + " lease_expires REAL, attempts INTEGER DEFAULT 0, result TEXT, error TEXT)",
+    "CREATE INDEX IF NOT EXISTS tasks_by_status ON tasks (status, id)",
+    "CREATE INDEX IF NOT EXISTS tasks_by_job ON tasks (job, chunk)",
+]
+
+
+class JobQueue:
+    """
+    The queue is a SQLite database, so it can live in a directory shared by all the hosts
+    (as long as the filesystem supports locking) or just in a local one for local workers
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.transaction() as connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Take the write lock right away, so that two workers never lease the same chunk
+        """
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            yield connection
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+
+    def submit(self, media: str, output: str, options: dict, chunks: list):
+        """
+        Add a job for `media` split into `chunks` of (start_ms, end_ms)
+        """
+        with self.transaction() as connection:
+            job = connection.execute(
+                "INSERT INTO jobs (media, output, options, status, created_at)"
+                + " VALUES (?, ?, ?, 'queued', ?)",
+                (str(media), str(output), json.dumps(options), time.time()),
+            ).lastrowid
+            connection.executemany(
+                "INSERT INTO tasks (job, chunk, chunks, start_ms, end_ms, status)"
+                + " VALUES (?, ?, ?, ?, ?, 'pending')",
+                [
+                    (job, chunk, len(chunks), start_ms, end_ms)
+                    for chunk, (start_ms, end_ms) in enumerate(chunks)
+                ],
+            )
+        return job
+
+    def lease(self, worker: str, lease_seconds: float = LEASE_SECONDS):
+        """
+        Hand the oldest chunk that is pending, or whose lease expired, to `worker`.
+        Chunks of finished jobs, or of jobs that already have a failed chunk, are skipped.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            expire_leases(connection, now)
+            task = connection.execute(
+                "SELECT tasks.*, jobs.media, jobs.options FROM tasks"
+                + " JOIN jobs ON jobs.id = tasks.job"
+                + " WHERE tasks.status = 'pending' AND jobs.status = 'queued'"
+                + " AND NOT EXISTS (SELECT 1 FROM tasks AS failed"
+                + " WHERE failed.job = tasks.job AND failed.status = 'failed')"
+                + " ORDER BY tasks.id LIMIT 1"
+            ).fetchone()
+            if not task:
+                return None
+            connection.execute(
+                "UPDATE tasks SET status = 'leased', worker = ?, lease_expires = ?,"
+                + " attempts = attempts + 1 WHERE id = ?",
+                (worker, now + lease_seconds, task["id"]),
+            )
+        task = dict(task)
+        task["options"] = json.loads(task["options"])
+        return task
+
+    def heartbeat(self, task: int, worker: str, lease_seconds: float = LEASE_SECONDS):
+        """
+        Extend the lease of a chunk. Returns False if the chunk is no longer leased to `worker`.
+        """
+        with self.transaction() as connection:
+            updated = connection.execute(
+                "UPDATE tasks SET lease_expires = ?"
+                + " WHERE id = ? AND worker = ? AND status = 'leased'",
+                (time.time() + lease_seconds, task, worker),
+            ).rowcount
+        return updated == 1
+
+    def complete(self, task: int, worker: str, result: str):
+        """
+        Store the captions of a chunk, unless its lease went to another worker meanwhile
+        """
+        with self.transaction() as connection:
+            updated = connection.execute(
+                "UPDATE tasks SET status = 'done', result = ?, lease_expires = NULL"
+                + " WHERE id = ? AND worker = ? AND status = 'leased'",
+                (result, task, worker),
+            ).rowcount
+        return updated == 1
+
+    def fail(self, task: int, worker: str, error: str):
+        """
+        Put a failed chunk back in the queue, or fail it for good after MAX_ATTEMPTS
+        """
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE tasks SET error = ?, lease_expires = NULL,"
+                + " status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END"
+                + " WHERE id = ? AND worker = ? AND status = 'leased'",
+                (error, MAX_ATTEMPTS, task, worker),
+            )
+
+    def requeue_expired(self):
+        """
+        Put the chunks of workers that stopped sending heartbeats back in the queue
+        """
+        with self.transaction() as connection:
+            return expire_leases(connection, time.time())
+
+    def progress(self, jobs: list):
+        """
+        The jobs with the number of their chunks in every status
+        """
+        placeholders = ", ".join("?" for _ in jobs)
+        with self.transaction() as connection:
+            rows = connection.execute(
+                "SELECT jobs.*, tasks.status AS task_status, COUNT(tasks.id) AS count"
+                + " FROM jobs JOIN tasks ON tasks.job = jobs.id"
+                + f" WHERE jobs.id IN ({placeholders})"
+                + " GROUP BY jobs.id, tasks.status ORDER BY jobs.id",
+                jobs,
+            ).fetchall()
+        progress = {}
+        for row in rows:
+            job = progress.setdefault(
+                row["id"],
+                {
+                    **{key: row[key] for key in ["id", "media", "output", "status"]},
+                    "options": json.loads(row["options"]),
+                    "chunks": {},
+                },
+            )
+            job["chunks"][row["task_status"]] = row["count"]
+        return list(progress.values())
+
+    def results(self, job: int):
+        """
+        The (start_ms, captions) of every chunk of a job, in order
+        """
+        with self.transaction() as connection:
+            rows = connection.execute(
+                "SELECT start_ms, result FROM tasks WHERE job = ? ORDER BY chunk",
+                (job,),
+            ).fetchall()
+        return [(row["start_ms"], row["result"]) for row in rows]
+
+    def errors(self, job: int):
+        with self.transaction() as connection:
+            rows = connection.execute(
+                "SELECT chunk, error FROM tasks WHERE job = ? AND status = 'failed'",
+                (job,),
+            ).fetchall()
+        return [f"chunk {row['chunk'] + 1}: {row['error']}" for row in rows]
+
+    def finish(self, job: int, status: str, error: str = None):
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, error, time.time(), job),
+            )
+
+    def cancel(self, job: int):
+        """
+        Cancel the chunks of a job that are still pending or leased, e.g. once the job failed.
+        Workers captioning one of them lose their lease and their captions are dropped.
+        """
+        with self.transaction() as connection:
+            return connection.execute(
+                "UPDATE tasks SET status = 'cancelled', lease_expires = NULL"
+                + " WHERE job = ? AND status IN ('pending', 'leased')",
+                (job,),
+            ).rowcount
+
+    def unfinished(self):
+        """
+        Number of chunks that are still pending or leased
+        """
+        with self.transaction() as connection:
+            return connection.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status IN ('pending', 'leased')"
+            ).fetchone()[0]
+
+
+def expire_leases(connection, now: float):
+    """
+    Put the chunks whose lease expired back in the queue, or fail them after MAX_ATTEMPTS
+    (e.g. chunks that crash every worker that takes them). Returns the number requeued.
+    """
+    connection.execute(
+        "UPDATE tasks SET status = 'failed', lease_expires = NULL,"
+        + " error = 'the worker stopped responding ' || attempts || ' times'"
+        + " WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+        (now, MAX_ATTEMPTS),
+    )
+    return connection.execute(
+        "UPDATE tasks SET status = 'pending', lease_expires = NULL"
+        + " WHERE status = 'leased' AND lease_expires < ?",
+        (now,),
+    ).rowcount
@@ -0,0 +1,319 @@
+"""
+Fingerprint index of captioned audio, to reuse the captions of the segments that recur
+across media (e.g. the intro, outro and sponsor reads of every episode of a series)
+"""
+
+import json
+import os
+import sqlite3
+import time
+
+from pathlib import Path
+
+import numpy as np
+
+from phonix_cues import CueTimeline
+
+DEFAULT_INDEX = Path(
+    os.environ.get("PHONIX_SEGMENT_INDEX", Path.home() / ".phonix" / "segments.sqlite3")
+)
+# Every frame of audio gets a 32-bit fingerprint, one bit per pair of neighbouring bands
+FRAME_SECONDS = 0.256
+HOP_SECONDS = 0.032
+BANDS = np.geomspace(300, 2000, 34)
+# Frames quieter than this (RMS) carry no fingerprint worth looking up
+SILENCE_RMS = 0.001
+# Frames are fingerprinted in blocks, so long media do not need all the frames in memory
+BLOCK_FRAMES = 1024
+# Hashes are looked up in batches below SQLite's limit of query parameters
+LOOKUP_BATCH = 500
+# Hashes that many recordings share (e.g. hum or music) say nothing about where a match is
+MAX_RECORDINGS_PER_HASH = 50
+# Number of matching hashes at the same offset to take a known recording into account
+MIN_VOTES = 8
+MAX_CANDIDATES = 20
+# Frames match when the share of different bits around them stays under this
+MAX_BIT_ERROR_RATE = 0.3
+SMOOTHING_FRAMES = 31
+# Recurring segments shorter than this are transcribed anyway
+MIN_SEGMENT_SECONDS = 8
+# Slivers of new audio shorter than this between recurring segments are not transcribed
+MIN_NOVEL_MS = 500
+
+
+def fingerprint(samples: np.ndarray, sample_rate: int):
+    """
+    The fingerprint of every frame of mono `samples`: the sign of how the energy
+    difference between neighbouring bands changes from the previous frame
+    """
+    frame_length = int(FRAME_SECONDS * sample_rate)
+    hop = int(HOP_SECONDS * sample_rate)
+    if len(samples) < frame_length + hop:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=bool)
+
+    frames = np.lib.stride_tricks.sliding_window_view(samples, frame_length)[::hop]
+    window = np.hanning(frame_length).astype(np.float32)
+    frequencies = np.fft.rfftfreq(frame_length, 1 / sample_rate)
+    band_of_bin = np.digitize(frequencies, BANDS) - 1
+    in_bands = (band_of_bin >= 0) & (band_of_bin < len(BANDS) - 1)
+
+    energies = []
+    loudness = []
+    for start in range(0, len(frames), BLOCK_FRAMES):
+        block = frames[start : start + BLOCK_FRAMES]
+        spectrum = np.abs(np.fft.rfft(block * window, axis=1)) ** 2
+        band_energy = np.zeros((len(block), len(BANDS) - 1), dtype=np.float64)
+        np.add.at(band_energy.T, band_of_bin[in_bands], spectrum[:, in_bands].T)
+        energies.append(band_energy)
+        loudness.append(np.sqrt(np.mean(np.square(block), axis=1)))
+    energies = np.concatenate(energies)
+    loudness = np.concatenate(loudness)
+
+    differences = energies[:, :-1] - energies[:, 1:]
+    bits = (differences[1:] - differences[:-1]) > 0
+    fingerprints = np.packbits(bits, axis=1, bitorder="little").view("<u4")[:, 0]
+    return fingerprints.astype(np.uint32), loudness[1:] > SILENCE_RMS
+
+
+def frames_to_ms(frames):
+    return np.asarray(frames, dtype=np.int64) * int(HOP_SECONDS * 1000)
+
+
+class SegmentIndex:
+    """
+    Previously captioned recordings, with the fingerprints of their frames and their cues.
+    Recordings are only matched against recordings captioned the same way (the `variant`).
+    """
+
+    def __init__(self, path: Path = DEFAULT_INDEX):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS recordings (id INTEGER PRIMARY KEY,"
+                + " media TEXT, variant TEXT, added_at REAL, fingerprints BLOB, cues TEXT)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS hashes (hash INTEGER, recording INTEGER, frame INTEGER)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS hashes_by_hash ON hashes (hash)"
+            )
+        connection.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def add(
+        self,
+        media: str,
+        variant: str,
+        fingerprints: np.ndarray,
+        audible: np.ndarray,
+        timeline: CueTimeline,
+        novel: list = None,
+    ):
+        """
+        Remember the fingerprints and the cues of a captioned recording. Only the frames of
+        the `novel` spans (in milliseconds) are indexed, the rest is already in the index.
+        """
+        frames = audible.copy()
+        if novel is not None:
+            spans = np.zeros(len(frames) + 1, dtype=np.int64)
+            hop_ms = int(HOP_SECONDS * 1000)
+            for start_ms, end_ms in novel:
+                spans[min(start_ms // hop_ms, len(frames))] += 1
+                spans[min(-(-end_ms // hop_ms), len(frames))] -= 1
+            frames &= np.cumsum(spans)[:-1] > 0
+        frames = np.flatnonzero(frames)
+
+        cues = {
+            "starts": timeline.starts.tolist(),
+            "ends": timeline.ends.tolist(),
+            "texts": timeline.texts.tolist(),
+        }
+        connection = self.connect()
+        known = connection.execute(
+            "SELECT id FROM recordings WHERE media = ? AND variant = ?",
+            (str(media), variant),
+        ).fetchone()
+        if known:
+            connection.close()
+            print(f"{media} is already in the segment index")
+            return
+        with connection:
+            recording = connection.execute(
+                "INSERT INTO recordings (media, variant, added_at, fingerprints, cues)"
+                + " VALUES (?, ?, ?, ?, ?)",
+                (
+                    str(media),
+                    variant,
+                    time.time(),
+                    fingerprints.astype("<u4").tobytes(),
+                    json.dumps(cues),
+                ),
+            ).lastrowid
+            connection.executemany(
+                "INSERT INTO hashes (hash, recording, frame) VALUES (?, ?, ?)",
+                zip(
+                    fingerprints[frames].tolist(),
+                    [recording] * len(frames),
+                    frames.tolist(),
+                ),
+            )
+        connection.close()
+
+    def match(
+        self,
+        variant: str,
+        fingerprints: np.ndarray,
+        audible: np.ndarray,
+        duration_ms: int,
+    ):
+        """
+        Find the spans of frames that recur in known recordings.
+        Returns the known cues moved to where they recur and the time spans
+        (in milliseconds) that still need to be transcribed.
+        """
+        connection = self.connect()
+        hits = self._lookup(connection, variant, fingerprints, audible)
+        spans = self._verify(connection, fingerprints, hits)
+        connection.close()
+
+        reused = []
+        regions = []
+        for start, end, recording, offset, cues in spans:
+            start_ms, end_ms = int(frames_to_ms(start)), int(frames_to_ms(end))
+            offset_ms = int(frames_to_ms(offset))
+            timeline = CueTimeline(cues["starts"], cues["ends"], cues["texts"])
+            # Where the span is in the known recording
+            known_start, known_end = start_ms - offset_ms, end_ms - offset_ms
+            inside = (timeline.starts >= known_start) & (timeline.ends <= known_end)
+            # Cues cut by the edges of the span are transcribed again, in full
+            cut_at_start = (timeline.starts < known_start) & (
+                timeline.ends > known_start
+            )
+            cut_at_end = (timeline.starts < known_end) & (timeline.ends > known_end)
+            if cut_at_start.any():
+                start_ms = int(timeline.ends[cut_at_start].max()) + offset_ms
+            if cut_at_end.any():
+                end_ms = int(timeline.starts[cut_at_end].min()) + offset_ms
+            if end_ms <= start_ms:
+                continue
+            timeline = CueTimeline(
+                timeline.starts[inside], timeline.ends[inside], timeline.texts[inside]
+            )
+            reused.append(timeline.shift(offset_ms))
+            regions.append((start_ms, end_ms))
+            print(
+                f"Reusing {len(timeline)} captions of {cues['media']}"
+                + f" for {start_ms / 1000:.1f}s-{end_ms / 1000:.1f}s"
+            )
+
+        novel = []
+        position = 0
+        for start_ms, end_ms in sorted(regions) + [(duration_ms, duration_ms)]:
+            if start_ms - position >= MIN_NOVEL_MS:
+                novel.append((position, start_ms))
+            position = max(position, end_ms)
+        return CueTimeline.concatenate(reused), novel
+
+    def _lookup(self, connection, variant, fingerprints, audible):
+        """
+        Votes for every (recording, frame offset) pair sharing hashes with the fingerprints
+        """
+        frames = np.flatnonzero(audible)
+        hashes, inverse = np.unique(fingerprints[frames], return_inverse=True)
+        rows = []
+        for start in range(0, len(hashes), LOOKUP_BATCH):
+            batch = hashes[start : start + LOOKUP_BATCH].tolist()
+            placeholders = ", ".join("?" for _ in batch)
+            rows += connection.execute(
+                "SELECT hash, recording, frame FROM hashes"
+                + " JOIN recordings ON recordings.id = hashes.recording"
+                + f" WHERE variant = ? AND hash IN ({placeholders})",
+                [variant, *batch],
+            ).fetchall()
+        if not rows:
+            return []
+
+        rows = np.array(rows, dtype=np.int64)
+        # Count every recording once per hash, however many of its frames have it
+        recordings = np.unique(rows[:, :2], axis=0)
+        row_hashes, counts = np.unique(recordings[:, 0], return_counts=True)
+        common = row_hashes[counts > MAX_RECORDINGS_PER_HASH]
+        rows = rows[~np.isin(rows[:, 0], common)]
+        if not len(rows):
+            return []
+        # Join every known frame with the new frames that have the same hash
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(len(hashes) + 1))
+        hash_ids = np.searchsorted(hashes, rows[:, 0])
+        repeats = bounds[hash_ids + 1] - bounds[hash_ids]
+        new_frames = frames[
+            order[
+                np.repeat(bounds[hash_ids], repeats)
+                + np.arange(repeats.sum())
+                - np.repeat(np.cumsum(repeats) - repeats, repeats)
+            ]
+        ]
+        pairs = np.stack(
+            [
+                np.repeat(rows[:, 1], repeats),
+                new_frames - np.repeat(rows[:, 2], repeats),
+            ],
+            axis=1,
+        )
+        candidates, votes = np.unique(pairs, axis=0, return_counts=True)
+        best = np.argsort(-votes, kind="stable")[:MAX_CANDIDATES]
+        return [
+            tuple(candidate)
+            for candidate in candidates[best][votes[best] >= MIN_VOTES].tolist()
+        ]
+
+    def _verify(self, connection, fingerprints, hits):
+        """
+        Compare the fingerprints frame by frame at the offsets with enough votes
+        and keep the longest spans that match, without overlaps
+        """
+        spans = []
+        recordings = {}
+        min_frames = int(MIN_SEGMENT_SECONDS / HOP_SECONDS)
+        kernel = np.ones(SMOOTHING_FRAMES) / SMOOTHING_FRAMES
+        for recording, offset in hits:
+            if recording not in recordings:
+                media, known, cues = connection.execute(
+                    "SELECT media, fingerprints, cues FROM recordings WHERE id = ?",
+                    (recording,),
+                ).fetchone()
+                recordings[recording] = (
+                    np.frombuffer(known, dtype="<u4"),
+                    {**json.loads(cues), "media": media},
+                )
+            known, cues = recordings[recording]
+
+            first = max(0, offset)
+            last = min(len(fingerprints), len(known) + offset)
+            if last - first < min_frames:
+                continue
+            different = np.bitwise_xor(
+                fingerprints[first:last], known[first - offset : last - offset]
+            )
+            bit_errors = np.unpackbits(
+                different.astype("<u4").view(np.uint8).reshape(-1, 4), axis=1
+            ).sum(axis=1)
+            error_rate = np.convolve(bit_errors / 32, kernel, mode="same")
+            matching = np.concatenate(
+                [[False], error_rate < MAX_BIT_ERROR_RATE, [False]]
+            )
+            edges = np.flatnonzero(np.diff(matching.astype(np.int8)))
+            for start, end in zip(edges[::2], edges[1::2]):
+                if end - start >= min_frames:
+                    spans.append((first + start, first + end, recording, offset, cues))
+
+        kept = []
+        for span in sorted(spans, key=lambda span: span[0] - span[1]):
+            if all(span[1] <= other[0] or span[0] >= other[1] for other in kept):
+                kept.append(span)
+        return sorted(kept, key=lambda span: span[0])